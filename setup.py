@@ -28,7 +28,7 @@ setup(
     ],
     entry_points='''
         [console_scripts]
-        yasha=yasha.cli:cli
+        yasha=yasha.daemon:main
     ''',
     classifiers=[
         "Topic :: Software Development :: Code Generators",
@@ -259,6 +259,27 @@ def test_variable_file_lookup(tmpdir, vartpl):
         assert output.read() == 'int x = {};'.format(i)
 
 
+def test_directory_listings_are_reused(tmpdir, monkeypatch):
+    import os
+    from yasha import yasha
+    tmpdir.chdir()
+    tmpdir.join('foo.c.j2').write('')
+    tmpdir.join('foo.toml').write('')
+    os.utime(str(tmpdir), (0, 0))
+
+    listdir = os.listdir
+    calls = []
+    monkeypatch.setattr(os, 'listdir', lambda p: calls.append(p) or listdir(p))
+    for _ in range(2):
+        companion = list(yasha.find_template_companion('foo.c.j2'))
+        assert companion == [str(tmpdir.join('foo.toml'))]
+    assert calls.count(str(tmpdir)) == 1
+
+    tmpdir.join('foo.c.py').write('')  # Updates the mtime of the directory
+    companion = list(yasha.find_template_companion('foo.c.j2'))
+    assert str(tmpdir.join('foo.c.py')) in companion
+
+
 def test_custom_xmlparser(tmpdir):
     template = """
     {% for p in persons %}
@@ -449,3 +470,451 @@ def test_extensions_file_with_do(tmpdir):
 
     out = check_output(('yasha', '-e', str(extensions), '-o-', str(tmpl)))
     assert out == b'[1, 2, 3, 4]'
+
+
+def test_bytecode_cache(tmpdir):
+    tmpdir.chdir()
+    cache = tmpdir.join('cache')
+
+    tpl = tmpdir.join('template.j2')
+    tpl.write('{% for x in range(3) %}{{ x }}{% endfor %}')
+
+    runner = CliRunner()
+    for _ in range(2):
+        result = runner.invoke(cli, ['--cache-dir', str(cache), '-o-', str(tpl)])
+        assert result.exit_code == 0
+        assert result.stdout_bytes == b'012'
+    assert len(cache.listdir('__jinja2_*')) == 1
+
+    # Changed template syntax must not hit the cached bytecode
+    ext = tmpdir.join('extensions.py')
+    ext.write("BLOCK_START_STRING = '<%'\nBLOCK_END_STRING = '%>'")
+    tpl.write('<% for x in range(3) %>{{ x }}<% endfor %>')
+    out = check_output(('yasha', '--cache-dir', str(cache), '-e', str(ext), '-o-', str(tpl)))
+    assert out == b'012'
+    assert len(cache.listdir('__jinja2_*')) == 2
+
+    # Filters must not be called already when compiling
+    ext.write('def filter_double(x):\n    return 2 * x\n')
+    tpl.write('{{ 2|double }}')
+    cmd = ('yasha', '--cache-dir', str(cache), '-e', str(ext), '-o-', str(tpl))
+    assert check_output(cmd) == b'4'
+    ext.write('def filter_double(x):\n    return 3 * x\n')
+    assert check_output(cmd) == b'6'
+
+
+def test_functions_digest_of_missing_extension_file(tmpdir):
+    from yasha.yasha import functions_digest
+    namespace = {'__name__': 'yasha_extensions', '__file__': 'missing.py'}
+    exec('def filter_double(x):\n    return 2 * x\n', namespace)
+    filters = {'double': namespace['filter_double']}
+
+    tmpdir.join('a').ensure(dir=True).chdir()
+    digest = functions_digest(filters)
+    tmpdir.join('b').ensure(dir=True).chdir()
+    assert functions_digest(filters) != digest
+
+
+def test_parsed_variables_are_cached(tmpdir, monkeypatch):
+    from yasha import cache, parsers
+    calls = []
+
+    def parse_counted(file):
+        calls.append(file.name)
+        return parsers.parse_yaml(file)
+
+    monkeypatch.setattr(cache, 'DIRECTORY', str(tmpdir.join('cache')))
+    monkeypatch.setattr(parsers, 'CACHEABLE', (parse_counted,))
+    file = tmpdir.join('vars.yaml')
+    file.write('x: 1')
+
+    for _ in range(2):
+        with open(str(file), 'rb') as f:
+            assert parsers.parse_cached(parse_counted, f) == {'x': 1}
+    assert len(calls) == 1
+
+    file.write('x: 2')
+    with open(str(file), 'rb') as f:
+        assert parsers.parse_cached(parse_counted, f) == {'x': 2}
+    assert len(calls) == 2
+
+
+def test_extension_code_is_cached(tmpdir, monkeypatch):
+    import yasha.cli
+    from yasha import cache
+    monkeypatch.setattr(cache, 'DIRECTORY', str(tmpdir.join('cache')))
+    ext = tmpdir.join('extensions.j2ext')
+    ext.write('def filter_double(x):\n    return 2 * x\n')
+
+    with open(str(ext), 'rb') as f:
+        module = yasha.cli.load_python_module(f)
+    assert len(tmpdir.join('cache', 'extensions').listdir()) == 1
+    tables = yasha.cli.find_extensions(module)
+    assert tables[1]['double'](2) == 4
+    assert yasha.cli.find_extensions(module) is tables
+
+    def compile(*args, **kwargs):
+        raise AssertionError('Extension file compiled again')
+
+    monkeypatch.setattr(yasha.cli, 'compile', compile, raising=False)
+    monkeypatch.setattr(yasha.cli, '_modules', dict())
+    tmpdir.chdir()
+    with open('extensions.j2ext', 'rb') as f:
+        module = yasha.cli.load_python_module(f)
+    assert module.filter_double(3) == 6
+
+    # The module is found by its real path also from another directory
+    tmpdir.join('sub').ensure(dir=True).chdir()
+    assert module.__file__ == path.realpath(str(ext))
+    assert yasha.cli.find_extensions(module)[1]['double'](3) == 6
+
+
+def test_csv_stream(tmpdir):
+    tmpdir.chdir()
+    tmpdir.join('data.csv').write('name,value\na,1\nb,2\n')
+    tpl = tmpdir.join('template.j2')
+    tpl.write(wrap("""
+        {%- for row in data %}{{ row.name }}={{ row.value }} {% endfor %}
+        {%- for row in data %}{{ loop.index }}/{{ loop.length }} {% endfor %}
+        {{- data|length }}
+        """))
+
+    runner = CliRunner()
+    for mode in ('list', 'stream'):
+        args = ['--csv-mode', mode, '-v', 'data.csv', '-o-', str(tpl)]
+        result = runner.invoke(cli, args)
+        assert result.exit_code == 0
+        assert result.stdout == 'a=1 b=2 1/2 2/2 2\n'
+
+    from yasha import parsers
+    with open('data.csv', 'rb') as f:
+        parsers.CSV_MODE = 'stream'
+        try:
+            rows = parsers.parse_csv(f)['data']
+        finally:
+            parsers.CSV_MODE = 'list'
+    assert isinstance(rows, parsers.CsvRows)
+    assert list(rows) == list(rows) == [
+        {'name': 'a', 'value': '1'}, {'name': 'b', 'value': '2'}]
+
+
+def test_csv_columns(tmpdir, monkeypatch):
+    from array import array
+    from yasha import parsers
+    monkeypatch.setitem(sys.modules, 'numpy', None)  # Test the fallback
+    monkeypatch.setattr(parsers, 'CSV_MODE', 'columns')
+    tmpdir.chdir()
+    tmpdir.join('data.csv').write('x,y,name\n1,0.5,a\n2,1,b\n3,-1e3,c\n')
+    tmpdir.join('raw.csv').write('1,2\n3,x\n4,5\n')
+
+    with open('data.csv', 'rb') as f:
+        data = parsers.parse_csv(f)['data']
+    assert data['x'] == array('q', [1, 2, 3])
+    assert data['y'] == array('d', [0.5, 1.0, -1000.0])
+    assert data['name'] == ['a', 'b', 'c']
+
+    with open('raw.csv', 'rb') as f:
+        raw = parsers.parse_csv(f)['raw']
+    assert raw == [array('q', [1, 3, 4]), ['2', 'x', '5']]
+
+    tpl = tmpdir.join('template.j2')
+    tpl.write('{{ data.x|sum }} {{ data.y|max }}')
+    args = ['--csv-mode', 'columns', '-v', 'data.csv', '-o-', str(tpl)]
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code == 0
+    assert result.stdout == '6 1.0'
+
+
+@pytest.mark.slowtest
+def test_yaml_loader_benchmark(tmpdir):
+    import yaml
+    import timeit
+    from yasha.parsers import yaml_loader
+    if not hasattr(yaml, 'CSafeLoader'):
+        pytest.skip('PyYAML is built without libyaml')
+
+    file = tmpdir.join('vars.yaml')
+    file.write(yaml.safe_dump(
+        {'reg{}'.format(i): {'offset': i * 4, 'fields': list(range(16))}
+         for i in range(2000)}
+    ))
+
+    results, times = [], []
+    for loader in ('python', 'c'):
+        assert yaml_loader(loader) is getattr(yaml, {
+            'python': 'SafeLoader', 'c': 'CSafeLoader'}[loader])
+        def parse():
+            with open(str(file), 'rb') as f:
+                return yaml.load(f, Loader=yaml_loader(loader))
+        results.append(parse())
+        times.append(min(timeit.repeat(parse, number=1, repeat=3)))
+        print('{} loader: {:.3f} s'.format(loader, times[-1]))  # pytest -s
+
+    assert results[0] == results[1]
+    assert yaml_loader('auto') is yaml.CSafeLoader
+
+
+def test_batch(tmpdir):
+    tmpdir.chdir()
+    tmpdir.mkdir('a').join('foo.c.j2').write('a {{ x }} {{ y }}')
+    tmpdir.mkdir('b').join('foo.c.j2').write('b {{ x }} {{ y }}')
+    tmpdir.join('vars.yaml').write('x: 1\ny: 2')
+    tmpdir.join('manifest.yaml').write(wrap("""
+        templates:
+          - a/foo.c.j2
+          - template: b/foo.c.j2
+            output: b/bar.c
+        """))
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['--y=3', '--batch', '-v', 'vars.yaml', 'manifest.yaml'])
+    assert result.exit_code == 0
+    assert tmpdir.join('a/foo.c').read() == 'a 1 3'
+    assert tmpdir.join('b/bar.c').read() == 'b 1 3'
+
+    result = runner.invoke(cli, ['--batch', '-M', '-v', 'vars.yaml', 'manifest.yaml'])
+    assert result.exit_code == 0
+    assert result.output.splitlines() == [
+        'a/foo.c: a/foo.c.j2 vars.yaml',
+        'b/bar.c: b/foo.c.j2 vars.yaml',
+    ]
+
+
+def test_batch_parallel(tmpdir):
+    tmpdir.chdir()
+    manifest = []
+    for i in range(8):
+        tmpdir.join('t{}.txt.j2'.format(i)).write('{{ i }}{{ x|double }}')
+        manifest.append('  - template: t{0}.txt.j2\n    output: t{0}.txt'.format(i))
+    tmpdir.join('manifest.yaml').write('templates:\n' + '\n'.join(manifest))
+    tmpdir.join('vars.toml').write('i = 7\nx = 21')
+    tmpdir.join('ext.py').write('def filter_double(x):\n    return 2 * x\n')
+
+    out = check_output(('yasha', '-j', '4', '-MD', '-v', 'vars.toml',
+                        '-e', 'ext.py', '--batch', 'manifest.yaml'))
+    for i in range(8):
+        assert tmpdir.join('t{}.txt'.format(i)).read() == '742'
+        deps = tmpdir.join('t{}.txt.d'.format(i)).read()
+        assert deps.startswith('t{0}.txt: t{0}.txt.j2 vars.toml ext.py'.format(i))
+
+
+def test_dependencies(tmpdir):
+    from yasha.cli import dependencies
+    tmpdir.chdir()
+    sub = tmpdir.mkdir('with space')
+    sub.join('foo.c.j2').write('{% include "header.j2inc" %}')
+    sub.join('header.j2inc').write('')
+    sub.join('foo.c.toml').write('')
+
+    deps = dependencies(path.join('with space', 'foo.c.j2'))
+    assert deps == [
+        path.join('with space', 'foo.c.j2'),
+        path.join('with space', 'foo.c.toml'),
+        path.join('with space', 'header.j2inc'),
+    ]
+
+    deps = dependencies(path.join('with space', 'foo.c.j2'),
+                        no_variable_file=True)
+    assert path.join('with space', 'foo.c.toml') not in deps
+
+
+def test_nested_dependencies(tmpdir):
+    tmpdir.chdir()
+    tmpdir.join('foo.c.j2').write('{% extends "base.j2inc" %}')
+    tmpdir.join('base.j2inc').write(dedent("""
+        {% import "macros.j2inc" as m %}
+        {% include "foo.c.j2" %}
+    """))
+    tmpdir.join('macros.j2inc').write('{% include "base.j2inc" %}')
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['-M', '--no-variable-file', 'foo.c.j2'])
+    assert result.exit_code == 0
+    assert result.output == 'foo.c: foo.c.j2 base.j2inc macros.j2inc\n'
+
+
+def test_depgraph(tmpdir):
+    import json
+    tmpdir.chdir()
+    src = tmpdir.mkdir('src')
+    src.join('foo.c.j2').write('{% include "header.j2inc" %}')
+    src.join('foo.c.py').write('')
+    src.join('foo.toml').write('')
+    src.join('header.j2inc').write('{% import "macros.j2inc" as m %}')
+    src.join('macros.j2inc').write('')
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['--depgraph', 'src', '-o', 'deps.json'])
+    assert result.exit_code == 0
+
+    index = json.loads(tmpdir.join('deps.json').read())
+    assert index['templates'] == {
+        path.join('src', 'foo.c.j2'): {
+            'output': path.join('src', 'foo.c'),
+            'includes': [path.join('src', 'header.j2inc'),
+                         path.join('src', 'macros.j2inc')],
+            'variables': [path.join('src', 'foo.toml')],
+            'extensions': path.join('src', 'foo.c.py'),
+        }
+    }
+
+    # Unmodified files are not parsed again
+    index['files'][path.join('src', 'header.j2inc')]['includes'] = []
+    tmpdir.join('deps.json').write(json.dumps(index))
+    result = runner.invoke(cli, ['--depgraph', 'src', '-o', 'deps.json'])
+    index = json.loads(tmpdir.join('deps.json').read())
+    includes = index['templates'][path.join('src', 'foo.c.j2')]['includes']
+    assert includes == [path.join('src', 'header.j2inc')]
+
+
+def test_emit_ninja(tmpdir):
+    tmpdir.chdir()
+    tmpdir.mkdir('src').join('foo.c.j2').write('{{ x }}')
+    tmpdir.join('vars.yaml').write('x: 1')
+    tmpdir.join('manifest.yaml').write('templates: [src/foo.c.j2]')
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ['--emit-ninja', '--batch', '-v', 'vars.yaml',
+                                 '-o', 'build.ninja', 'manifest.yaml'])
+    assert result.exit_code == 0
+
+    ninja = tmpdir.join('build.ninja').read()
+    assert 'flags = --variables vars.yaml --no-variable-file' in ninja
+    assert 'command = yasha $flags --if-changed -MD -o $out $in' in ninja
+    assert 'depfile = $out.d' in ninja
+    assert 'restat = 1' in ninja
+    assert 'build {}: yasha {}'.format(
+        path.join('src', 'foo.c'), path.join('src', 'foo.c.j2')) in ninja
+
+
+def test_if_changed(tmpdir):
+    from os import utime
+    tmpdir.chdir()
+    tmpdir.join('foo.c.j2').write('{{ x }}')
+    output = tmpdir.join('foo.c')
+    depfile = tmpdir.join('foo.c.d')
+
+    runner = CliRunner()
+    args = ['--if-changed', '-MD', '--no-variable-file', 'foo.c.j2']
+    result = runner.invoke(cli, ['--x=1'] + args)
+    assert result.exit_code == 0
+    assert output.read() == '1'
+    utime(str(output), (0, 0))
+    utime(str(depfile), (0, 0))
+
+    result = runner.invoke(cli, ['--x=1'] + args)
+    assert result.exit_code == 0
+    assert output.mtime() == 0
+    assert depfile.mtime() == 0
+
+    result = runner.invoke(cli, ['--x=2'] + args)
+    assert result.exit_code == 0
+    assert output.read() == '2'
+    assert output.mtime() != 0
+    assert depfile.mtime() == 0
+
+
+def test_async(tmpdir, monkeypatch):
+    tmpdir.chdir()
+    tmpdir.join('a.j2').write('{{ "echo a" | shell }} {{ x | twice }}')
+    tmpdir.join('b.j2').write('{{ "echo b" | shell }} {{ x | twice }}')
+    tmpdir.join('manifest.yaml').write('templates: [a.j2, b.j2]')
+    tmpdir.join('extensions.py').write(dedent("""
+        async def filter_twice(value):
+            return value * 2
+    """))
+
+    runner = CliRunner()
+    args = ['--x=1', '-e', 'extensions.py', '--batch', 'manifest.yaml']
+    result = runner.invoke(cli, ['--async'] + args)
+    assert result.exit_code == 0
+    assert tmpdir.join('a').read() == 'a 2'
+    assert tmpdir.join('b').read() == 'b 2'
+
+    # Async mode is enabled automatically due to the coroutine filter
+    tmpdir.join('a').remove()
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0
+    assert tmpdir.join('a').read() == 'a 2'
+
+    # Shell commands are prefetched in async mode too
+    from yasha import filters
+    prefetched = []
+    monkeypatch.setattr(filters, 'prefetch', prefetched.extend)
+    result = runner.invoke(cli, ['--shell-prefetch'] + args)
+    assert result.exit_code == 0
+    assert sorted(c[0] for c in prefetched) == ['echo a', 'echo b']
+
+
+def test_daemon_is_not_forwarded_serve_calls():
+    from yasha.daemon import starts_server
+    assert starts_server(['--serve', 'yasha.sock'])
+    assert starts_server(['--serve=yasha.sock'])
+    assert not starts_server(['--server.j2'])
+
+
+@pytest.mark.skipif(not hasattr(__import__('socket'), 'AF_UNIX'),
+                    reason="Requires Unix domain sockets")
+def test_daemon(tmpdir):
+    import os
+    import time
+    tmpdir.chdir()
+    address = str(tmpdir.join('yasha.sock'))
+    daemon = subprocess.Popen(('yasha', '--serve', address))
+    try:
+        for _ in range(50):
+            if path.exists(address):
+                break
+            time.sleep(0.1)
+
+        env = dict(os.environ, YASHA_SERVER=address)
+        tmpdir.join('foo.txt.j2').write('{{ x|double }}')
+        tmpdir.join('foo.txt.py').write('def filter_double(x):\n    return 2 * x\n')
+
+        out = check_output(('yasha', '--x=2', '-o-', 'foo.txt.j2'), env=env)
+        assert out == b'4'
+
+        tmpdir.join('foo.txt.py').write('def filter_double(x):\n    return 3 * x\n')
+        check_output(('yasha', '--x=2', 'foo.txt.j2'), env=env)
+        assert tmpdir.join('foo.txt').read() == '6'
+
+        # Parallel calls are rendered concurrently by the workers
+        tmpdir.join('sleep.j2').write('{{ "sleep 1" | shell }}')
+        start = time.time()
+        calls = [subprocess.Popen(('yasha', '-o', str(i), 'sleep.j2'), env=env)
+                 for i in range(4)]
+        assert [p.wait() for p in calls] == [0] * 4
+        assert time.time() - start < 3.5
+
+        # Each call gets its own copy of the parsed variables
+        tmpdir.join('vars.yaml').write('items: [1]')
+        tmpdir.join('append.j2').write('{% set _ = items.append(9) %}{{ items }}')
+        for _ in range(2):
+            cmd = ('yasha', '-v', 'vars.yaml', '-o-', 'append.j2')
+            assert check_output(cmd, env=env) == b'[1, 9]'
+
+        cmd = ('yasha', '--mode=pedantic', '-')
+        p = subprocess.run(cmd, env=env, input=b'{{ y }}', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        assert p.returncode == 1
+        assert p.stderr.startswith(b"Error: Variable 'y' is undefined")
+    finally:
+        daemon.terminate()
+        daemon.wait()
+    assert not path.exists(address)
+
+
+def test_import_time():
+    import yasha
+    root = path.dirname(path.dirname(path.abspath(yasha.__file__)))
+    cmd = (sys.executable, '-X', 'importtime', '-c', 'import yasha.cli')
+    p = subprocess.run(cmd, cwd=root, stdout=subprocess.PIPE,
+                       stderr=subprocess.PIPE)
+    assert p.returncode == 0
+    imported = set()
+    for line in p.stderr.decode().splitlines():
+        if line.startswith('import time:') and '|' in line:
+            imported.add(line.rsplit('|', 1)[1].strip())
+    assert 'yasha.cli' in imported
+    lazy = ('jinja2', 'yaml', 'pytoml', 'xmltodict', 'yasha.cmsis',
+            'subprocess', 'pickle')
+    assert not imported.intersection(lazy)
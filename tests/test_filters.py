@@ -25,6 +25,7 @@ THE SOFTWARE.
 import os
 import sys
 import subprocess
+import time
 
 import pytest
 
@@ -94,3 +95,84 @@ def test_subprocess_with_unknown_cmd_while_check_is_false():
     )
     out, retcode = check_output('yasha', '-', stdin=template)
     assert out == b'True'
+
+
+@requires_py3
+def test_shell_cache(tmpdir):
+    counter = tmpdir.join('counter')
+    template = (
+        '{% set cmd = "echo x >> ' + str(counter) + '; wc -l < '
+        + str(counter) + '" %}'
+        '{{ cmd | shell }} {{ cmd | shell }} {{ cmd | shell(cache=False) }}'
+    )
+    out, retcode = check_output('yasha', '--shell-cache', '-', stdin=template)
+    assert out == b'1 1 2'
+
+    out, retcode = check_output('yasha', '-', stdin=template)
+    assert out == b'3 4 5'
+
+    cache = str(tmpdir.join('cache'))
+    args = ('--shell-cache', '--shell-cache-ttl', '60', '--cache-dir', cache)
+    out, retcode = check_output('yasha', *args, '-', stdin=template)
+    assert out == b'6 6 7'
+    out, retcode = check_output('yasha', *args, '-', stdin=template)
+    assert out == b'6 6 8'
+
+    # Zero seconds expires the results right away
+    args = ('--shell-cache', '--shell-cache-ttl', '0', '--cache-dir', cache)
+    out, retcode = check_output('yasha', *args, '-', stdin=template)
+    assert out == b'9 10 11'
+
+
+def test_filters_table_keeps_plain_functions(monkeypatch):
+    from yasha.filters import FILTERS
+    monkeypatch.setenv('YASHA_TEST', 'foo')
+    assert FILTERS['env']('YASHA_TEST') == 'foo'
+    assert FILTERS['shell']('echo bar') == 'bar'
+
+
+@requires_py3
+def test_find_shell_commands():
+    from jinja2 import Environment
+    from yasha.filters import FILTERS, find_shell_commands
+    env = Environment()
+    env.filters.update(FILTERS)
+    source = (
+        '{{ "git describe" | shell }}'
+        '{{ "uname" | subprocess(stderr=False, timeout=5) }}'
+        '{{ cmd | shell }}'
+    )
+    assert find_shell_commands(env, source) == [
+        ('git describe', True, False, 2),
+        ('uname', True, False, 5),
+    ]
+
+
+@requires_py3
+def test_shell_prefetch(tmpdir):
+    tmpdir.join('template.j2').write(
+        '{{ "sleep 1; echo a" | shell }} {{ "sleep 1; echo b" | shell }}'
+    )
+    template = str(tmpdir.join('template.j2'))
+    start = time.time()
+    out, retcode = check_output('yasha', '--shell-prefetch', '-o-', template)
+    assert out == b'a b'
+    assert time.time() - start < 1.8  # Two seconds when run one by one
+
+
+@requires_py3
+def test_shell_prefetch_skips_cached_commands(tmpdir):
+    counter = tmpdir.join('counter')
+    tmpdir.join('template.j2').write(
+        '{{ "echo x >> ' + str(counter) + '; wc -l < ' + str(counter)
+        + '" | shell }}'
+    )
+    template = str(tmpdir.join('template.j2'))
+    args = (
+        '--shell-prefetch', '--shell-cache', '--shell-cache-ttl', '60',
+        '--cache-dir', str(tmpdir.join('cache')),
+    )
+    for _ in range(2):
+        out, retcode = check_output('yasha', *args, '-o-', template)
+        assert out == b'1'
+    assert counter.read() == 'x\n'
@@ -283,6 +283,16 @@ def test_svdfile():
         assert periph.name == "TIMER{}".format(idx)
 
 
+def test_svdfile_from_string_keeps_encoding():
+    file = cmsis.SVDFile(
+        '<?xml version="1.0" encoding="iso-8859-1"?>'
+        '<device><description>Température</description></device>'
+    )
+    assert file.root.tag == "device"  # Parsed already on init
+    file.parse()
+    assert file.device.description == "Température"
+
+
 def test_nrf51svd_to_rust(fixtures_dir):
     tpl = path.join(fixtures_dir, "nrf51.rs.jinja")
     ext = path.join(fixtures_dir, "nrf51.rs.py")
@@ -293,3 +303,183 @@ def test_nrf51svd_to_rust(fixtures_dir):
         cmd = "cat {} | yasha -e {} -v {} -".format(tpl, ext, var)
         out = check_output(cmd, shell=True)
         assert out.strip() == f.read().strip()
+
+
+def test_parsed_svd_is_cached(tmpdir, fixtures_dir, monkeypatch):
+    from yasha import cache, parsers
+    monkeypatch.setattr(cache, 'DIRECTORY', str(tmpdir))
+
+    svd = path.join(fixtures_dir, "nrf51.svd")
+    with open(svd, "rb") as f:
+        first = parsers.parse_svd(f)
+    assert len(tmpdir.join('svd').listdir()) == 1
+
+    def fail(*args, **kwargs):
+        raise AssertionError("SVD file parsed again")
+    monkeypatch.setattr(cmsis.SVDFile, 'parse', fail)
+
+    with open(svd, "rb") as f:
+        second = parsers.parse_svd(f)
+    assert second['device'].name == first['device'].name
+    assert [p.name for p in second['peripherals']] == \
+        [p.name for p in first['peripherals']]
+    reg = second['peripherals'][0].registers[0]
+    assert reg.parent is second['peripherals'][0]
+
+
+def test_svdfile_is_parsed_incrementally():
+    from io import BytesIO
+    file = cmsis.SVDFile(BytesIO(
+        b"""<?xml version="1.0" encoding="utf-8"?>
+        <device schemaVersion="1.1">
+            <name>DEV</name>
+            <size>32</size>
+            <cpu><name>CM0</name></cpu>
+            <peripherals>
+                <peripheral>
+                    <name>TIMER0</name>
+                    <registers>
+                        <register><name>CTRL</name></register>
+                    </registers>
+                </peripheral>
+                <peripheral derivedFrom="TIMER0">
+                    <name>TIMER1</name>
+                </peripheral>
+            </peripherals>
+        </device>
+        """
+    ))
+    file.parse()
+
+    assert file.device.name == "DEV"
+    assert file.device.schemaVersion == "1.1"
+    assert file.cpu.name == "CM0"
+    assert [p.name for p in file.peripherals] == ["TIMER0", "TIMER1"]
+    assert file.peripherals[0].size == 32  # Device default
+    assert file.peripherals[1].registers[0].name == "CTRL"
+
+    # Peripheral elements are discarded after parsed
+    assert len(file.root.find("peripherals")) == 0
+
+
+def test_svd_elements_use_slots():
+    element = et.fromstring(
+        "<field><name>EN</name><bitOffset>0x4</bitOffset></field>"
+    )
+    field = cmsis.SvdField(element)
+
+    assert not hasattr(field, "__dict__")
+    assert field.name == "EN"
+    assert field.bitOffset == 4
+    assert field.description is None  # Absent property
+    assert field.copy().name == "EN"
+    with pytest.raises(AttributeError):
+        field.foo
+
+    # Only the properties read as None, not the other attributes
+    constraint = cmsis.SvdWriteConstraint(et.fromstring(
+        "<writeConstraint><writeAsRead>true</writeAsRead></writeConstraint>"
+    ))
+    assert constraint.writeAsRead is True
+    assert constraint.useEnumeratedValues is None
+    with pytest.raises(AttributeError):
+        constraint.range
+    with pytest.raises(AttributeError):
+        cmsis.SvdAddressBlock(None).size  # No SVD element
+
+
+def test_register_array_is_folded_lazily():
+    periph = cmsis.SvdPeripheral(et.fromstring(
+        """
+        <peripheral>
+            <name>GPIO</name>
+            <registers>
+                <register><name>CTRL</name></register>
+                <register>
+                    <dim>3</dim>
+                    <dimIncrement>4</dimIncrement>
+                    <dimIndex>0-2</dimIndex>
+                    <name>PIN%s</name>
+                    <addressOffset>0x10</addressOffset>
+                    <fields><field><name>EN</name></field></fields>
+                </register>
+                <register><name>STATUS</name></register>
+            </registers>
+        </peripheral>
+        """
+    ))
+    regs = periph.registers
+
+    assert len(regs) == 5
+    assert [r.name for r in regs] == \
+        ["CTRL", "PIN0", "PIN1", "PIN2", "STATUS"]
+    assert [r.addressOffset for r in regs[1:4]] == [0x10, 0x14, 0x18]
+    assert regs[-1].name == "STATUS"
+    assert regs[2].dim is None
+    assert [f.name for f in regs[2].fields] == ["EN"]
+    assert [f.parent.name for f in regs[2].fields] == ["PIN1"]
+    register = regs[3]
+    assert register.fields[0].parent is register
+
+
+def test_svdfile_is_parsed_selectively():
+    from io import BytesIO
+    file = cmsis.SVDFile(BytesIO(
+        b"""<?xml version="1.0" encoding="utf-8"?>
+        <device schemaVersion="1.1">
+            <name>DEV</name>
+            <peripherals>
+                <peripheral>
+                    <name>TIMER0</name>
+                    <registers>
+                        <register>
+                            <name>CTRL</name>
+                            <fields><field><name>EN</name></field></fields>
+                        </register>
+                    </registers>
+                </peripheral>
+                <peripheral derivedFrom="TIMER0">
+                    <name>TIMER1</name>
+                </peripheral>
+                <peripheral><name>UART0</name></peripheral>
+            </peripherals>
+        </device>
+        """
+    ))
+    file.parse(peripherals=["TIMER1", "GPIO*"], depth="registers")
+
+    assert [p.name for p in file.peripherals] == ["TIMER1"]
+    assert file.peripherals[0].registers[0].name == "CTRL"  # Inherited
+    assert file.peripherals[0].registers[0].fields == []
+
+
+def test_svdfile_reads_skipped_bases_again():
+    from io import BytesIO
+
+    class Stream(BytesIO):
+        def seekable(self):
+            return False
+
+    svd = """<?xml version="1.0" encoding="utf-8"?>
+    <device schemaVersion="1.1">
+        <name>DEV</name>
+        <peripherals>
+            <peripheral>
+                <name>TIMER0</name>
+                <registers><register><name>CTRL</name></register></registers>
+            </peripheral>
+            <peripheral derivedFrom="TIMER0"><name>TIMER1</name></peripheral>
+            <peripheral derivedFrom="UART1"><name>UART0</name></peripheral>
+            <peripheral>
+                <name>UART1</name>
+                <registers><register><name>DATA</name></register></registers>
+            </peripheral>
+        </peripherals>
+    </device>
+    """
+    for file in (svd, BytesIO(svd.encode()), Stream(svd.encode())):
+        file = cmsis.SVDFile(file)
+        file.parse(peripherals=["TIMER1", "UART0"])
+        assert [p.name for p in file.peripherals] == ["TIMER1", "UART0"]
+        assert file.peripherals[0].registers[0].name == "CTRL"
+        assert file.peripherals[1].registers[0].name == "DATA"
@@ -0,0 +1,88 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015-2021 Kim Blomqvist
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import sys
+
+DIRECTORY = None  # Set via --cache-dir, caching is disabled if None
+
+
+def digest(*parts):
+    """Returns a hex digest of the given str and bytes objects"""
+    import hashlib
+    h = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        h.update(part)
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def file_digest(file, *parts):
+    """Returns a hex digest of the file content and the given parts.
+    The file is rewound back to the beginning.
+    """
+    import hashlib
+    h = hashlib.sha1()
+    for chunk in iter(lambda: file.read(1 << 20), b''):
+        h.update(chunk)
+    file.seek(0)
+    return digest(h.hexdigest(), sys.version, *parts)
+
+
+def path(namespace, key):
+    return os.path.join(DIRECTORY, namespace, key + '.pickle')
+
+
+def load(namespace, key, default=None):
+    """Returns the object cached under the key or the default"""
+    if DIRECTORY is None:
+        return default
+    import pickle
+    try:
+        with open(path(namespace, key), 'rb') as f:
+            return pickle.load(f)
+    except Exception:  # Not cached, or corrupted or incompatible entry
+        return default
+
+
+def dump(namespace, key, obj):
+    """Caches the object under the key. The cache entry is written
+    atomically, so parallel Yasha processes can share the cache. Objects
+    which cannot be pickled are silently left out of the cache.
+    """
+    if DIRECTORY is None:
+        return
+    import pickle
+    import tempfile
+    filename = path(namespace, key)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, filename)
+    except Exception:
+        os.unlink(tmp)
@@ -23,14 +23,18 @@ THE SOFTWARE.
 
 """
 
+import io
 import os
+import sys
 import encodings
 
 import click
 from click import ClickException
-from jinja2.exceptions import UndefinedError as JinjaUndefinedError
 
 from . import yasha
+from . import cache
+from . import parsers
+from . import filters
 from .tests import TESTS
 from .filters import FILTERS
 from .classes import CLASSES
@@ -42,30 +46,108 @@ def print_version(ctx, param, value):
     click.echo(yasha.__version__)
     ctx.exit()
 
+def serve(ctx, param, value):
+    if not value or ctx.resilient_parsing:
+        return
+    from . import daemon
+    daemon.serve(value)
+    ctx.exit()
+
+# Loaded files are kept in memory by their path and modification time,
+# so that the daemon and batch mode don't need to load them again.
+_variables = dict()  # Pickled, so that each call gets its own copy
+_modules = dict()
+_extensions = dict()
+_environments = dict()
+
+KEEP_VARIABLES = False  # Set by the daemon, see parse_variable_file()
+MAX_ENVIRONMENTS = 8  # E.g. every edit of an extension file adds one
+
+def file_stamp(filename):
+    try:
+        stat = os.stat(filename)
+    except OSError:  # E.g. '<stdin>'
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
 def parse_variable_file(file):
     try:
         file_extension = os.path.splitext(file.name)[1]
-        return PARSERS[file_extension](file)
+        parse = PARSERS[file_extension]
+        stamp = file_stamp(file.name)
+        if stamp is None:
+            return parse(file)
+        if not KEEP_VARIABLES:
+            return parsers.parse_cached(parse, file)
+        # The variables may be modified when rendering, so they are kept
+        # pickled, and every call unpickles a fresh copy of them
+        import pickle
+        path = os.path.realpath(file.name)
+        key = (stamp, parse, parsers.options())
+        if _variables.get(path, (None,))[0] == key:
+            return pickle.loads(_variables[path][1])
+        variables = parsers.parse_cached(parse, file)
+        try:
+            data = pickle.dumps(variables, pickle.HIGHEST_PROTOCOL)
+        except Exception:  # Not picklable, parsed again on every call
+            return variables
+        _variables[path] = (key, data)
+        return variables
     except AttributeError:
         return dict()
     except KeyError:
         error = "Unkown variable file extension '{}'"
         raise ClickException(error.format(file_extension))
 
+def compile_python_module(filename):
+    """
+    Returns the code object of the Python file. With --cache-dir the code
+    is cached on disk by the path and content of the file.
+    """
+    import marshal
+    with open(filename, 'rb') as f:
+        source = f.read()
+    path = os.path.realpath(filename)
+    key = cache.digest(path, source, sys.version)
+    code = cache.load('extensions', key)
+    if code is not None:
+        try:
+            return marshal.loads(code)
+        except (EOFError, ValueError, TypeError):  # Corrupted entry
+            pass
+    code = compile(source, filename, 'exec', dont_inherit=True)
+    cache.dump('extensions', key, marshal.dumps(code))
+    return code
+
 def load_python_module(file):
+    import types
+    path = os.path.realpath(file.name)
+    stamp = file_stamp(path)
+    if stamp is not None and _modules.get(path, (None,))[0] == stamp:
+        sys.modules['yasha_extensions'] = _modules[path][1]
+        return _modules[path][1]
+    code = compile_python_module(file.name)
+    module = types.ModuleType('yasha_extensions')
+    module.__file__ = path
+    sys.modules['yasha_extensions'] = module
     try:
-        from importlib.machinery import SourceFileLoader
-        loader = SourceFileLoader('yasha_extensions', file.name)
-        module = loader.load_module()
-    except ImportError:  # Fallback to Python2
-        import imp
-        with open(file.name) as f:
-            desc = (".py", "rb", imp.PY_SOURCE)
-            module = imp.load_module('yasha_extensions', f, file.name, desc)
-        pass
+        exec(code, module.__dict__)
+    except BaseException:
+        del sys.modules['yasha_extensions']
+        raise
+    _modules[path] = (stamp, module)
     return module
 
-def load_extensions(file):
+def find_extensions(module):
+    """
+    Returns the tests, filters, parsers, extension classes and Jinja
+    defaults found in the extension module. The tables are kept in memory
+    along with the module.
+    """
+    path = os.path.realpath(module.__file__)
+    if _extensions.get(path, (None,))[0] is module:
+        return _extensions[path][1]
+
     from jinja2.ext import Extension
     import inspect
 
@@ -74,17 +156,6 @@ def load_extensions(file):
     parsers = dict()
     classes = []
 
-    try:
-        module = load_python_module(file)
-    except NameError as e:
-        msg = 'Unable to load extensions, {}'
-        raise ClickException(msg.format(e))
-    except SyntaxError as e:
-        msg = "Unable to load extensions\n{} ({}, line {})"
-        error = e.msg[0].upper() + e.msg[1:]
-        filename = os.path.relpath(e.filename)
-        raise ClickException(msg.format(error, filename, e.lineno))
-
     for attr in [getattr(module, x) for x in dir(module)]:
         if inspect.isfunction(attr):
             if attr.__name__.startswith('test_'):
@@ -101,29 +172,552 @@ def load_extensions(file):
                 classes.append(attr)
 
     import jinja2.defaults
-    for name, obj in inspect.getmembers(module):
-        if name in tuple(x for x in dir(jinja2.defaults) if x.isupper()):
-            setattr(jinja2.defaults, name, obj)
+    names = tuple(x for x in dir(jinja2.defaults) if x.isupper())
+    defaults = {name: obj for name, obj in inspect.getmembers(module)
+                if name in names}
+
+    tests = getattr(module, 'TESTS', tests)
+    filters = getattr(module, 'FILTERS', filters)
+    parsers = getattr(module, 'PARSERS', parsers)
+    classes = getattr(module, 'CLASSES', classes)
+
+    tables = (tests, filters, parsers, classes, defaults)
+    _extensions[path] = (module, tables)
+    return tables
 
+def load_extensions(file):
     try:
-        TESTS.update(module.TESTS)
-    except AttributeError:
-        TESTS.update(tests)
+        module = load_python_module(file)
+    except NameError as e:
+        msg = 'Unable to load extensions, {}'
+        raise ClickException(msg.format(e))
+    except SyntaxError as e:
+        msg = "Unable to load extensions\n{} ({}, line {})"
+        error = e.msg[0].upper() + e.msg[1:]
+        filename = os.path.relpath(e.filename)
+        raise ClickException(msg.format(error, filename, e.lineno))
+
+    tests, filters, parsers, classes, defaults = find_extensions(module)
+
+    import jinja2.defaults
+    for name, obj in defaults.items():
+        setattr(jinja2.defaults, name, obj)
+
+    TESTS.update(tests)
+    FILTERS.update(filters)
+    PARSERS.update(parsers)
+    CLASSES.extend(classes)
+
 
+def get_jinja(path, **options):
+    """
+    Returns Jinja environment loaded with the current tests, filters and
+    extension classes. The environment, and so the compiled templates, is
+    reused by the later calls with the same settings.
+    """
+    import jinja2.defaults
+    defaults = [(x, getattr(jinja2.defaults, x)) for x in dir(jinja2.defaults)
+                if x.isupper()]
+    key = (
+        tuple(path), tuple(sorted(options.items())), tuple(defaults),
+        tuple(sorted(TESTS.items())), tuple(sorted(FILTERS.items())),
+        tuple(CLASSES),
+    )
     try:
-        FILTERS.update(module.FILTERS)
-    except AttributeError:
-        FILTERS.update(filters)
+        return _environments[key]
+    except TypeError:  # Unhashable, e.g. a filter
+        key = None
+    except KeyError:
+        pass
+
+    jinja = yasha.load_jinja(
+        path=path,
+        tests=TESTS,
+        filters=FILTERS,
+        classes=CLASSES,
+        **options
+    )
+    if key is not None:
+        if len(_environments) >= MAX_ENVIRONMENTS:  # Drop the oldest one
+            del _environments[next(iter(_environments))]
+        _environments[key] = jinja
+    return jinja
+
+def load_manifest(file):
+    """
+    Returns a list of (template, output) pairs read from the batch
+    manifest. Paths are relative to the manifest file.
+    """
+    manifest = parse_variable_file(file)
+    if isinstance(manifest, dict):
+        manifest = manifest.get('templates', [])
+
+    basedir = os.path.dirname(file.name) if file.name != '<stdin>' else ''
+
+    entries = []
+    for entry in manifest:
+        if isinstance(entry, str):
+            template, output = entry, None
+        else:
+            try:
+                template = entry['template']
+            except (KeyError, TypeError):
+                msg = "Invalid manifest entry '{}', template is missing"
+                raise ClickException(msg.format(entry))
+            output = entry.get('output')
+        template = os.path.join(basedir, template)
+        if output is None:
+            output = os.path.splitext(template)[0]
+        else:
+            output = os.path.join(basedir, output)
+        entries.append((template, output))
+    return entries
+
+def load_template_files(template, variables, extensions,
+                        no_variable_file=False, no_extension_file=False):
+    """Returns the variable and extension files of the template. The
+    template companions are used unless the files are given explicitly.
+    The extensions are loaded, as they may define parsers for the
+    variable files.
+    """
+    if not extensions or not variables:
+        template_companion = yasha.find_template_companion(template)
+        template_companion = list(template_companion)
+
+    if not extensions and not no_extension_file:
+        for file in template_companion:
+            if file.endswith(yasha.EXTENSION_FILE_FORMATS):
+                extensions = click.open_file(file, "rb")
+                break
+
+    if extensions:
+        load_extensions(extensions)
+
+    if not variables and not no_variable_file:
+        for file in template_companion:
+            if file.endswith(tuple(PARSERS.keys())):
+                variables = (click.open_file(file, "rb"),)
+                break
+
+    return variables, extensions
+
+def dependencies(template, variables=(), extensions=None, include_path=(),
+                 no_variable_file=False, no_extension_file=False):
+    """Returns the list of files the template depends on, i.e. the files
+    listed by option -M. The arguments correspond to the command-line
+    options but the files are given by their names.
+    """
+    variables = [click.open_file(f, "rb", lazy=True) for f in variables]
+    if extensions:
+        extensions = click.open_file(extensions, "rb")
+    variables, extensions = load_template_files(
+        template, variables, extensions, no_variable_file, no_extension_file
+    )
 
+    files = [f.name for f in variables]
+    if extensions:
+        files.append(extensions.name)
+    for f in list(variables) + [extensions]:
+        if f:
+            f.close()
+
+    include_path = [os.path.dirname(template)] + list(include_path)
+    with open(template, "rb") as f:
+        return list_dependencies(f, files, include_path)
+
+def find_templates(directory):
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for file in sorted(files):
+            if file.endswith(yasha.TEMPLATE_FILE_FORMATS):
+                yield os.path.join(root, file)
+
+def load_depgraph(filename):
+    """
+    Reads the dependency index written earlier and takes the referenced
+    templates of the unmodified files into use. A file is unmodified if
+    its modification time and size, or the content hash, still match.
+    """
+    import json
+    import hashlib
     try:
-        PARSERS.update(module.PARSERS)
-    except AttributeError:
-        PARSERS.update(parsers)
+        with open(filename, 'rb') as f:
+            files = json.loads(f.read().decode('utf-8'))['files']
+        entries = list(files.items())
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return  # No usable index
+
+    for name, entry in entries:
+        path = os.path.realpath(name)
+        stamp = file_stamp(path)
+        try:
+            if stamp is None:
+                continue
+            if list(stamp) != entry['stamp']:
+                with open(path, 'rb') as f:
+                    digest = hashlib.sha1(f.read()).hexdigest()
+                if digest != entry['sha1']:
+                    continue
+            yasha._referenced[path] = (stamp, entry['sha1'], entry['includes'])
+        except (KeyError, TypeError):
+            continue
+
+def depgraph(directory, variables=(), extensions=None, include_path=(),
+             no_variable_file=False, no_extension_file=False):
+    """
+    Returns the dependency index of the templates found under the
+    directory. For each template the index lists the output, the
+    referenced templates (transitively) and the variable and extension
+    files. The index also records the referenced templates of each
+    scanned file for updating the index incrementally.
+    """
+    templates = dict()
+    scanned = set()
+    for template in find_templates(directory):
+        search_path = [os.path.dirname(template)] + list(include_path)
+        with open(template, 'rb') as f:
+            includes = yasha.find_referenced_templates(f, search_path)
+        scanned.add(os.path.realpath(template))
+        scanned.update(includes)
+
+        companion = list(yasha.find_template_companion(template))
+        template_variables = list(variables)
+        if not template_variables and not no_variable_file:
+            for file in companion:
+                if file.endswith(tuple(PARSERS.keys())):
+                    template_variables = [file]
+                    break
+        template_extensions = extensions
+        if not template_extensions and not no_extension_file:
+            for file in companion:
+                if file.endswith(yasha.EXTENSION_FILE_FORMATS):
+                    template_extensions = file
+                    break
+
+        templates[os.path.relpath(template)] = dict(
+            output=os.path.relpath(os.path.splitext(template)[0]),
+            includes=[os.path.relpath(f) for f in includes],
+            variables=[os.path.relpath(f) for f in template_variables],
+            extensions=os.path.relpath(template_extensions)
+                if template_extensions else None,
+        )
+
+    files = dict()
+    for path in sorted(scanned):
+        stamp, digest, includes = yasha._referenced[path]
+        files[os.path.relpath(path)] = dict(
+            stamp=list(stamp), sha1=digest, includes=includes
+        )
+
+    return dict(templates=templates, files=files)
+
+def write_depgraph(directory, output, variables, extensions, include_path,
+                   no_variable_file, no_extension_file):
+    import json
+    if not output:
+        output = click.open_file("-", "wb")
+    elif output.name != "-":
+        load_depgraph(output.name)
+
+    index = depgraph(
+        directory, [f.name for f in variables],
+        extensions.name if extensions else None, include_path,
+        no_variable_file, no_extension_file
+    )
+    index = json.dumps(index, indent=2, sort_keys=True) + "\n"
+    output.write(index.encode("utf-8"))
+
+def ninja_escape(path):
+    return path.replace("$", "$$").replace(" ", "$ ").replace(":", "$:")
+
+def ninja_flags(ctx, basedir):
+    """
+    Returns the options of the current command-line call to be passed
+    on to the render commands of the Ninja build file. Paths are made
+    relative to the directory of the build file.
+    """
+    skip = ("template", "output", "depgraph", "emit_ninja", "batch", "jobs",
+            "if_changed", "m", "md")
+    flags = list(ctx.params["template_variables"])
+    for param in ctx.command.params:
+        if not isinstance(param, click.Option) or param.name in skip:
+            continue
+        values = ctx.params.get(param.name)
+        if not param.multiple:
+            values = [values]
+        for value in values or ():
+            if value is None or value is False or value == param.default:
+                continue
+            if param.is_flag:
+                flags.append(param.opts[0])
+                continue
+            if isinstance(param.type, (click.File, click.Path)):
+                value = os.path.relpath(getattr(value, "name", value), basedir)
+            flags += [param.opts[0], str(value)]
+    return flags
+
+def write_ninja(entries, output, flags, basedir):
+    """
+    Writes a Ninja build file rendering the (template, output) entries.
+    The templates are rendered with option -MD, so Ninja knows their
+    dependencies after the first build.
+    """
+    import shlex
+    flags = " ".join(shlex.quote(f) for f in flags)
+
+    def path(filename):
+        return ninja_escape(os.path.relpath(filename, basedir))
+
+    lines = [
+        "# Generated by yasha --emit-ninja",
+        "",
+        "flags = " + flags.replace("$", "$$"),
+        "",
+        "rule yasha",
+        "  command = yasha $flags --if-changed -MD -o $out $in",
+        "  depfile = $out.d",
+        "  deps = gcc",
+        "  restat = 1",
+        "  description = YASHA $out",
+        "",
+    ]
+    for template, out in entries:
+        lines.append("build {}: yasha {}".format(path(out), path(template)))
+
+    output.write((os.linesep.join(lines) + os.linesep).encode("utf-8"))
+
+def list_dependencies(template, files, include_path):
+    deps = [template.name] + list(files)
+    deps += yasha.find_referenced_templates(template, include_path)
+    return [os.path.relpath(d) for d in deps]
+
+class ChangedOutputFile(io.BytesIO):
+    """
+    Output file kept in memory and written on close only if its content
+    differs from the existing file. The file is replaced atomically, so
+    its modification time changes only when the content does.
+    """
+
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:  # Leave the existing file as is
+            super().close()
+
+    def close(self):
+        if not self.closed:
+            write_if_changed(self.name, self.getvalue())
+        super().close()
 
+def write_if_changed(filename, data):
+    import tempfile
     try:
-        CLASSES.extend(module.CLASSES)
-    except AttributeError:
-        CLASSES.extend(classes)
+        if os.path.getsize(filename) == len(data):
+            with open(filename, "rb") as f:
+                if f.read() == data:
+                    return  # Unchanged
+        mode = os.stat(filename).st_mode & 0o777
+    except OSError:  # Doesn't exist yet
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+
+    directory, basename = os.path.split(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix="." + basename)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(tmp, mode)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def open_output(filename, if_changed=False):
+    if if_changed and filename != "-":
+        return ChangedOutputFile(filename)
+    return click.open_file(filename, "wb", lazy=True)
+
+def write_dependencies(output, deps, if_changed=False):
+    deps = os.path.relpath(output) + ": " + " ".join(deps) + os.linesep
+    with open_output(output + ".d", if_changed) as f:
+        f.write(deps.encode(yasha.ENCODING))
+
+def prefetch_shell_commands(t):
+    if t.name is None:  # E.g. from STDIN
+        return
+    env = t.environment
+    source = env.loader.get_source(env, t.name)[0]
+    filters.prefetch(filters.find_shell_commands(env, source))
+
+def render(t, context, output):
+    from jinja2.exceptions import UndefinedError as JinjaUndefinedError
+    try:
+        if filters.SHELL_PREFETCH:
+            prefetch_shell_commands(t)
+        t_stream = t.stream(context)
+        t_stream.enable_buffering(size=5)
+        t_stream.dump(output, encoding=yasha.ENCODING)
+    except JinjaUndefinedError as e:
+        raise ClickException("Variable {}".format(e))
+    finally:
+        filters._prefetched.clear()
+
+
+class BatchRenderer(object):
+    """Renders templates with the shared Jinja environment and context"""
+
+    def __init__(self, jinja, context, include_path, files=(), md=False,
+                 if_changed=False):
+        self.jinja = jinja
+        self.context = context
+        self.include_path = include_path
+        self.files = files  # Shared variable and extension files
+        self.md = md
+        self.if_changed = if_changed
+        self.envs = dict()  # One overlay per template directory
+
+    def dependencies(self, template, output):
+        path = [os.path.dirname(template)] + self.include_path
+        with click.open_file(template, "rb") as f:
+            deps = list_dependencies(f, self.files, path)
+        return os.path.relpath(output) + ": " + " ".join(deps)
+
+    def get_template(self, template, output):
+        """Returns the template, and writes its .d file if requested"""
+        from jinja2 import FileSystemLoader
+
+        template_dir = os.path.dirname(template)
+        if template_dir not in self.envs:
+            path = [template_dir] + self.include_path
+            loader = FileSystemLoader(path)
+            self.envs[template_dir] = self.jinja.overlay(loader=loader)
+        t = self.envs[template_dir].get_template(os.path.basename(template))
+
+        if self.md:
+            path = [template_dir] + self.include_path
+            with click.open_file(template, "rb") as f:
+                deps = list_dependencies(f, self.files, path)
+            write_dependencies(output, deps, self.if_changed)
+        return t
+
+    def render(self, template, output):
+        t = self.get_template(template, output)
+        with open_output(output, self.if_changed) as f:
+            render(t, self.context, f)
+
+    async def render_async(self, template, output):
+        from jinja2.exceptions import UndefinedError as JinjaUndefinedError
+        t = self.get_template(template, output)
+        if filters.SHELL_PREFETCH:  # In a thread not to block the others
+            import asyncio
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, prefetch_shell_commands, t)
+        try:
+            content = await t.render_async(self.context)
+        except JinjaUndefinedError as e:
+            raise ClickException("Variable {}".format(e))
+        with open_output(output, self.if_changed) as f:
+            f.write(content.encode(yasha.ENCODING))
+
+
+_batch_renderer = None  # Per process renderer of the batch workers
+
+def _init_batch_worker(extensions, context, include_path, files, md,
+                       if_changed, jinja_options, encoding, shell_options):
+    import sys
+    global _batch_renderer
+
+    yasha.ENCODING = encoding
+    cache.DIRECTORY = jinja_options['cache_dir']
+    (filters.SHELL_CACHE, filters.SHELL_CACHE_TTL, filters.SHELL_CACHE_ENV,
+     filters.SHELL_PREFETCH) = shell_options
+    if extensions and 'yasha_extensions' not in sys.modules:
+        # Not inherited from the parent process, e.g. on Windows
+        load_extensions(click.open_file(extensions, "rb"))
+
+    jinja = yasha.load_jinja(
+        path=include_path,
+        tests=TESTS,
+        filters=FILTERS,
+        classes=CLASSES,
+        **jinja_options
+    )
+    _batch_renderer = BatchRenderer(jinja, context, include_path, files, md,
+                                    if_changed)
+
+def _render_batch_entry(entry):
+    try:
+        _batch_renderer.render(*entry)
+    except ClickException as e:
+        return e.format_message()
+
+def render_batch(manifest, variables, extensions, include_path,
+                 cli_variables, jinja_options, m, md, jobs=1,
+                 if_changed=False):
+    if extensions:
+        load_extensions(extensions)
+
+    files = [f.name for f in variables]
+    if extensions:
+        files.append(extensions.name)
+
+    entries = load_manifest(manifest)
+
+    if m:
+        renderer = BatchRenderer(None, None, include_path, files)
+        for template, output in entries:
+            click.echo(renderer.dependencies(template, output))
+        return  # Templates won't be rendered
+
+    context = dict()  # Parsed only once for all the templates
+    for file in variables:
+        context.update(parse_variable_file(file))
+    context.update(cli_variables)
+
+    if jobs > 1:
+        from multiprocessing import Pool
+        initargs = (
+            extensions.name if extensions else None,
+            context, include_path, files, md, if_changed, jinja_options,
+            yasha.ENCODING, (filters.SHELL_CACHE, filters.SHELL_CACHE_TTL,
+                             filters.SHELL_CACHE_ENV, filters.SHELL_PREFETCH)
+        )
+        with Pool(jobs, _init_batch_worker, initargs) as pool:
+            errors = pool.imap_unordered(_render_batch_entry, entries)
+            errors = [e for e in errors if e is not None]
+        if errors:
+            raise ClickException(os.linesep.join(errors))
+        return
+
+    jinja = get_jinja(include_path, **jinja_options)
+    renderer = BatchRenderer(jinja, context, include_path, files, md,
+                             if_changed)
+
+    if jinja.is_async:  # Render the templates concurrently
+        import asyncio
+
+        async def render_all():
+            await asyncio.gather(*[
+                renderer.render_async(template, output)
+                for template, output in entries
+            ])
+        loop = asyncio.new_event_loop()  # asyncio.run() requires 3.7
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(render_all())
+        finally:
+            filters._prefetched.clear()
+            asyncio.set_event_loop(None)
+            loop.close()
+        return
+
+    for template, output in entries:
+        renderer.render(template, output)
 
 
 @click.command(context_settings=dict(
@@ -131,7 +725,7 @@ def load_extensions(file):
     ignore_unknown_options=True,
 ))
 @click.argument("template_variables", nargs=-1, type=click.UNPROCESSED)
-@click.argument("template", type=click.File("rb"))
+@click.argument("template", type=click.File("rb"), required=False)
 @click.option("--output", "-o", type=click.File("wb"), help="Place the rendered template into FILENAME.")
 @click.option("--variables", "-v", type=click.File("rb"), multiple=True, help="Read template variables from FILENAME. Built-in parsers are JSON, YAML, TOML and XML.")
 @click.option("--extensions", "-e", envvar='YASHA_EXTENSIONS', type=click.File("rb"), help="Read template extensions from FILENAME. A Python file is expected.")
@@ -143,14 +737,33 @@ def load_extensions(file):
 @click.option("--no-lstrip-blocks", is_flag=True, help="Load Jinja with lstrip_blocks=False.")
 @click.option("--remove-trailing-newline", is_flag=True, help="Load Jinja with keep_trailing_newline=False.")
 @click.option("--mode", type=click.Choice(['pedantic', 'debug']), help="In pedantic mode Yasha becomes extremely picky on templates, e.g. undefined variables will raise an error. In debug mode undefined variables will print as is.")
+@click.option("--async", "enable_async", is_flag=True, help="Load Jinja in async mode. Batch templates are rendered concurrently, and the shell and subprocess filters don't block each other.")
+@click.option("--cache-dir", envvar='YASHA_CACHE_DIR', type=click.Path(file_okay=False), help="Cache compiled templates and parsed variable files into DIRECTORY to speed up repeated renders.")
+@click.option("--yaml-loader", type=click.Choice(["auto", "c", "python"]), default="auto", help="Parse YAML files with the libyaml based loader (c), the pure Python loader (python), or the former if available (auto).")
+@click.option("--csv-mode", type=click.Choice(["list", "stream", "columns"]), default="list", help="Load CSV files as lists of rows (list), as sequences reading the rows from the file on iteration (stream), or as columns of typed arrays (columns).")
+@click.option("--svd-peripherals", metavar="PATTERNS", help="Parse only the SVD peripherals matching the comma separated shell-style PATTERNS, e.g. 'GPIO*,UART0'.")
+@click.option("--svd-depth", type=click.Choice(["peripherals", "registers", "fields"]), help="Parse SVD files only down to the given level.")
+@click.option("--shell-cache", is_flag=True, help="Cache the results of shell and subprocess filters by the command, working directory and the environment variables given by --shell-cache-env.")
+@click.option("--shell-cache-ttl", metavar="SECONDS", type=click.FloatRange(min=0), help="Expire the cached shell results after SECONDS. With --cache-dir the results are cached on disk and shared between the calls.")
+@click.option("--shell-cache-env", metavar="NAME", multiple=True, help="Add environment variable NAME to the key of the cached shell results.")
+@click.option("--shell-prefetch", is_flag=True, help="Run the shell and subprocess filter calls with constant arguments concurrently before rendering.")
+@click.option("--depgraph", metavar="DIRECTORY", type=click.Path(exists=True, file_okay=False), help="Write the dependency index of all the templates under DIRECTORY in JSON format. An existing index given by --output is updated incrementally.")
+@click.option("--emit-ninja", is_flag=True, help="Write a Ninja build file rendering TEMPLATE, or the templates listed by the --batch manifest, instead of rendering.")
+@click.option("--batch", is_flag=True, help="Read TEMPLATE as a manifest listing the templates to be rendered. Variable and extension files are shared by all the templates and automatic file look up is not done.")
+@click.option("--jobs", "-j", default=1, type=click.IntRange(min=1), help="Render the batch templates in N parallel processes.")
+@click.option("--if-changed", is_flag=True, help="Write the output files, and the .d files, only if their content changes. Keeps the modification times of unchanged files.")
 @click.option("-M", is_flag=True, help="Outputs Makefile compatible list of dependencies. Doesn't render the template.")
 @click.option("-MD", is_flag=True, help="Creates Makefile compatible .d file alongside the rendered template.")
+@click.option("--serve", metavar="SOCKET", callback=serve, expose_value=False, is_eager=True, help="Run as a daemon rendering the templates requested via Unix domain SOCKET. Clients connect to the daemon given by YASHA_SERVER environment variable.")
 @click.option('--version', is_flag=True, callback=print_version, expose_value=False, is_eager=True, help="Print version and exit.")
 def cli(
         template_variables, template, output, variables, extensions,
         encoding, include_path, no_variable_file, no_extension_file,
         no_trim_blocks, no_lstrip_blocks, remove_trailing_newline,
-        mode, m, md):
+        mode, enable_async, cache_dir, yaml_loader, csv_mode,
+        svd_peripherals, svd_depth, shell_cache, shell_cache_ttl,
+        shell_cache_env, shell_prefetch, depgraph, emit_ninja, batch, jobs,
+        if_changed, m, md):
     """Reads the given Jinja TEMPLATE and renders its content
     into a new file. For example, a template called 'foo.c.j2'
     will be written into 'foo.c' in case the output file is not
@@ -171,28 +784,72 @@ def cli(
         msg = "Unrecognized encoding name '{}'"
         raise ClickException(msg.format(encoding))
     yasha.ENCODING = encoding
+    cache.DIRECTORY = cache_dir
+
+    if svd_peripherals is not None:
+        svd_peripherals = tuple(p.strip() for p in svd_peripherals.split(","))
+    parsers.YAML_LOADER = yaml_loader
+    parsers.CSV_MODE = csv_mode
+    parsers.SVD_PERIPHERALS = svd_peripherals
+    parsers.SVD_DEPTH = svd_depth
+    filters.SHELL_CACHE = shell_cache
+    filters.SHELL_CACHE_TTL = shell_cache_ttl
+    filters.SHELL_CACHE_ENV = shell_cache_env
+    filters.SHELL_PREFETCH = shell_prefetch
+
+    jinja_options = dict(
+        mode=mode,
+        trim_blocks=not no_trim_blocks,
+        lstrip_blocks=not no_lstrip_blocks,
+        keep_trailing_newline=not remove_trailing_newline,
+        cache_dir=cache_dir,
+        enable_async=enable_async,
+    )
+
+    if depgraph:
+        if template:
+            raise click.UsageError("Option '--depgraph' doesn't take TEMPLATE")
+        write_depgraph(depgraph, output, variables, extensions,
+                       list(include_path), no_variable_file, no_extension_file)
+        return
 
-    # Append include path of referenced templates
-    include_path = [os.path.dirname(template.name)] + list(include_path)
+    if template is None:
+        raise click.UsageError("Missing argument 'TEMPLATE'.")
 
-    if not extensions or not variables:
-        template_companion = yasha.find_template_companion(template.name)
-        template_companion = list(template_companion)
+    if emit_ninja:
+        if not output:
+            output = click.open_file("-", "wb")
+        if output.name == "-":
+            basedir = os.getcwd()
+        else:
+            basedir = os.path.dirname(os.path.abspath(output.name))
+        flags = ninja_flags(click.get_current_context(), basedir)
+        if batch:
+            entries = load_manifest(template)
+            # Keep the batch semantics, no automatic file look up
+            for flag in ("--no-variable-file", "--no-extension-file"):
+                if flag not in flags:
+                    flags.append(flag)
+        else:
+            entries = [(template.name, os.path.splitext(template.name)[0])]
+        write_ninja(entries, output, flags, basedir)
+        return
 
-    if not extensions and not no_extension_file:
-        for file in template_companion:
-            if file.endswith(yasha.EXTENSION_FILE_FORMATS):
-                extensions = click.open_file(file, "rb")
-                break
+    if batch:
+        if output:
+            raise ClickException("Option '--output' cannot be used with '--batch'")
+        render_batch(template, variables, extensions, list(include_path),
+                     yasha.parse_cli_variables(template_variables),
+                     jinja_options, m, md, jobs, if_changed)
+        return
 
-    if extensions:
-        load_extensions(extensions)
+    # Append include path of referenced templates
+    include_path = [os.path.dirname(template.name)] + list(include_path)
 
-    if not variables and not no_variable_file:
-        for file in template_companion:
-            if file.endswith(tuple(PARSERS.keys())):
-                variables = (click.open_file(file, "rb"),)
-                break
+    variables, extensions = load_template_files(
+        template.name, variables, extensions,
+        no_variable_file, no_extension_file
+    )
 
     if not output:
         if template.name == "<stdin>":
@@ -202,34 +859,18 @@ def cli(
             output = click.open_file(output, "wb", lazy=True)
 
     if m or md:
-        deps = [os.path.relpath(template.name)]
-        for file in variables:
-            deps.append(os.path.relpath(file.name))
+        files = [f.name for f in variables]
         if extensions:
-            deps.append(os.path.relpath(extensions.name))
-        for d in yasha.find_referenced_templates(template, include_path):
-            deps.append(os.path.relpath(d))
-
-        deps = os.path.relpath(output.name) + ": " + " ".join(deps)
+            files.append(extensions.name)
+        deps = list_dependencies(template, files, include_path)
         if m:
-            click.echo(deps)
+            click.echo(os.path.relpath(output.name) + ": " + " ".join(deps))
             return  # Template won't be rendered
         if md:
-            deps += os.linesep
-            output_d = click.open_file(output.name + ".d", "wb")
-            output_d.write(deps.encode(yasha.ENCODING))
+            write_dependencies(output.name, deps, if_changed)
 
     # Load Jinja
-    jinja = yasha.load_jinja(
-        path=include_path,
-        tests=TESTS,
-        filters=FILTERS,
-        classes=CLASSES,
-        mode=mode,
-        trim_blocks=not no_trim_blocks,
-        lstrip_blocks=not no_lstrip_blocks,
-        keep_trailing_newline=not remove_trailing_newline
-   )
+    jinja = get_jinja(include_path, **jinja_options)
 
     # Get template
     if template.name == "<stdin>":
@@ -245,9 +886,8 @@ def cli(
     context.update(yasha.parse_cli_variables(template_variables))
 
     # Finally render template and save it
-    try:
-        t_stream = t.stream(context)
-        t_stream.enable_buffering(size=5)
-        t_stream.dump(output, encoding=yasha.ENCODING)
-    except JinjaUndefinedError as e:
-        raise ClickException("Variable {}".format(e))
+    if if_changed and output.name != "-":
+        with open_output(output.name, if_changed) as f:
+            render(t, context, f)
+    else:
+        render(t, context, output)
@@ -22,6 +22,10 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+from bisect import bisect_right
+from collections.abc import Sequence
+from fnmatch import fnmatchcase
+from io import StringIO
 from xml.etree import ElementTree
 
 class SVDFile():
@@ -34,37 +38,180 @@ class SVDFile():
 
     def __init__(self, file):
         if isinstance(file, str):
+            self.file = None
             self.root = ElementTree.fromstring(file)
+            self._text = file  # To read the skipped peripherals again
         else:
-            tree = ElementTree.parse(file)
-            self.root = tree.getroot()
+            self.file = file
+            self.root = None  # Read by parse()
 
         self.cpu = None
         self.device = None
         self.peripherals = []
         self.peripherals_dict = {}  # Lookup by peripheral name
 
-    def parse(self):
-        self.cpu = SvdCpu(self.root.find("cpu"))
-        self.device = SvdDevice(self.root)
-
+    def parse(self, peripherals=None, depth=None):
+        """Parses the SVD file incrementally. Each peripheral is parsed as
+        soon as its end tag is read and the corresponding XML element is
+        then discarded, so the whole XML tree is never held in memory.
+
+        Parsing can be limited to the peripherals whose name matches any of
+        the given shell-style patterns, and to the given depth of the SVD
+        hierarchy, see DEPTHS. The XML elements of the other peripherals
+        are discarded too, except for the derivedFrom bases of the selected
+        ones. The bases read before they were known to be needed are read
+        again from the file afterwards.
+        """
         derived_periphs = []
-        for elem in self.root.iter("peripheral"):
+        bases = set()  # Names of the derivedFrom bases
+        skipped = {}  # XML elements of the bases not selected
+        stack = []
+        # Non-seekable files can't be read again, so all the peripherals
+        # not selected are kept as the possible bases instead
+        rereadable = self.file is None or self.file.seekable()
+
+        if self.file is None:  # Already parsed from a string
+            events = iterevents(self.root)
+        else:
+            events = ElementTree.iterparse(self.file, ("start", "end"))
+
+        for event, elem in events:
+            if event == "start":
+                if self.root is None:
+                    self.root = elem
+                stack.append(elem)
+                continue
+
+            stack.pop()
+            if elem.tag != "peripheral":
+                continue
+
+            if self.device is None:
+                # Device level elements precede the peripherals and
+                # are needed as defaults for the peripherals
+                self.device = SvdDevice(self.root)
+
+            if stack:
+                stack[-1].remove(elem)
+
+            name = elem.findtext("name")
+            if peripherals is not None and \
+                    not any(fnmatchcase(name, p) for p in peripherals):
+                if name in bases or not rereadable:
+                    prune(elem, depth)
+                    skipped[name] = elem
+                else:
+                    elem.clear()
+                continue
+
+            prune(elem, depth)
             periph = SvdPeripheral(elem, self.device)
             if periph.derivedFrom is not None:
                 derived_periphs.append(periph.name)
+                bases.add(periph.derivedFrom)
             self.peripherals.append(periph)
             self.peripherals_dict[periph.name] = periph
+            elem.clear()
+
+        self.cpu = SvdCpu(self.root.find("cpu"))
+        if self.device is None:
+            self.device = SvdDevice(self.root)
+
+        missing = bases.difference(self.peripherals_dict, skipped)
+        if missing:
+            skipped.update(self.find_peripherals(missing, depth))
 
         for periph in [self.peripherals_dict[name] for name in derived_periphs]:
-            base = self.peripherals_dict[periph.derivedFrom]
+            base = self.peripherals_dict.get(periph.derivedFrom)
+            if base is None:  # Not selected, parse just for the inheritance
+                elem = skipped[periph.derivedFrom]
+                prune(elem, depth)
+                base = SvdPeripheral(elem, self.device)
             periph.inherit_from(base)
 
+    def find_peripherals(self, names, depth=None):
+        """Reads the SVD file again for the XML elements of the named
+        peripherals, pruned to the given depth. Reading stops as soon as
+        all of them are found.
+        """
+        if self.file is None:
+            source = StringIO(self._text)
+        else:
+            self.file.seek(0)
+            source = self.file
+
+        found = {}
+        for event, elem in ElementTree.iterparse(source):
+            if elem.tag != "peripheral":
+                continue
+            name = elem.findtext("name")
+            if name not in names:
+                elem.clear()
+                continue
+            prune(elem, depth)
+            found[name] = elem
+            if len(found) == len(names):
+                break
+        return found
+
+
+def iterevents(element):
+    """Yields the start and end events of the element tree like
+    ElementTree.iterparse(). Child elements may be removed meanwhile.
+    """
+    yield "start", element
+    for child in list(element):
+        yield from iterevents(child)
+    yield "end", element
+
+
+DEPTHS = ("peripherals", "registers", "fields")
+
+
+def prune(peripheral, depth=None):
+    """Removes the XML subtrees below the given depth from the peripheral
+    element. Nothing is removed if the depth is None.
+    """
+    if depth is None:
+        return
+    level = DEPTHS.index(depth)
+    if level == 0:
+        for elem in peripheral.findall("registers"):
+            peripheral.remove(elem)
+    elif level == 1:
+        for register in peripheral.iter("register"):
+            for elem in register.findall("fields"):
+                register.remove(elem)
+    elif level == 2:
+        for field in peripheral.iter("field"):
+            for elem in field.findall("enumeratedValues"):
+                field.remove(elem)
+
 
 class SvdElement(object):
+    """Base class of the SVD elements
+
+    The elements are stored compactly by using __slots__. Properties absent
+    from the SVD element are not stored at all, but read as None. Elements
+    created without an SVD element have no properties.
+    """
+    __slots__ = ["parent", "_parsed"]
+    _attributes = ("parent",)
+    _attribute_set = frozenset(_attributes)
+
     props = []
-    props_to_integer = []
-    props_to_boolean = []
+    props_to_integer = frozenset()
+    props_to_boolean = frozenset()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        attributes = []
+        for klass in reversed(cls.__mro__):
+            for name in klass.__dict__.get("__slots__", []):
+                if name not in attributes and not name.startswith("_"):
+                    attributes.append(name)
+        cls._attributes = tuple(attributes)
+        cls._attribute_set = frozenset(attributes)
 
     def __init__(self, element=None, defaults={}, parent=None):
         if element is not None:
@@ -72,31 +219,63 @@ class SvdElement(object):
         if parent is not None:
             self.parent = parent
 
+    def __getattr__(self, name):
+        # Called only if the attribute has not been set
+        if name in self.props and self._is_parsed():
+            return None
+        msg = "'{}' object has no attribute '{}'"
+        raise AttributeError(msg.format(type(self).__name__, name))
+
+    def _is_parsed(self):
+        try:
+            return object.__getattribute__(self, "_parsed")
+        except AttributeError:
+            return False
+
     def from_element(self, element, defaults={}):
         """Populate object variables from SVD element"""
-        if isinstance(defaults, SvdElement):
-            defaults = vars(defaults)
+        self._parsed = True
+        children = {}  # Index the child elements in a single pass
+        for child in element:
+            children.setdefault(child.tag, child)
+
         for key in self.props:
-            try:
-                value = element.find(key).text
-            except AttributeError:  # Maybe it's attribute?
-                default = defaults[key] if key in defaults else None
+            if key in children:
+                value = children[key].text
+            else:  # Maybe it's attribute?
+                if isinstance(defaults, SvdElement):
+                    default = getattr(defaults, key, None)
+                else:
+                    default = defaults[key] if key in defaults else None
                 value = element.get(key, default)
-            if value is not None:
-                if key in self.props_to_integer:
-                    try:
-                        value = int(value)
-                    except ValueError:  # It has to be hex
-                        value = int(value, 16)
-                elif key in self.props_to_boolean:
-                    value = value.lower() in ("yes", "true", "t", "1")
+            if value is None:
+                continue  # Absent properties are not stored
+            if key in self.props_to_integer:
+                try:
+                    value = int(value)
+                except ValueError:  # It has to be hex
+                    value = int(value, 16)
+            elif key in self.props_to_boolean:
+                value = value.lower() in ("yes", "true", "t", "1")
 
             setattr(self, key, value)
 
+    def asdict(self):
+        """Returns the stored attributes as a dictionary"""
+        attributes = {}
+        parsed = self._is_parsed()
+        for key in self._attributes:
+            try:
+                attributes[key] = object.__getattribute__(self, key)
+            except AttributeError:
+                if parsed and key in self.props:  # Absent property
+                    attributes[key] = None
+        return attributes
+
     def inherit_from(self, element):
-        for key, value in vars(self).items():
-            if not value and key in vars(element):
-                value = getattr(element, key)
+        for key in self._attributes:
+            value = getattr(element, key, None)
+            if value is not None and not getattr(self, key, True):
                 setattr(self, key, value)
 
     def copy(self):
@@ -105,7 +284,7 @@ class SvdElement(object):
 
     def __str__(self):
         from pprint import pformat
-        return pformat(vars(self), indent=0)
+        return pformat(self.asdict(), indent=0)
 
 
 class SvdDevice(SvdElement):
@@ -116,9 +295,10 @@ class SvdDevice(SvdElement):
         "headerDefinitionsPrefix", "addressUnitBits", "width", "size",
         "access", "protection", "resetValue", "resetMask"
     ]
-    props_to_integer = [
+    props_to_integer = {
         "width", "size", "resetValue", "resetMask", "addressUnitBits"
-    ]
+    }
+    __slots__ = props
 
 
 class SvdCpu(SvdElement):
@@ -129,10 +309,12 @@ class SvdCpu(SvdElement):
         "vtorPresent", "nvicPrioBits", "vendorSystickConfig",
         "deviceNumInterrupts"
     ]
-    props_to_boolean = [
+    props_to_boolean = {
         "mpuPresent", "fpuPresent", "fpuDP", "icachePresent", "dcachePresent",
         "itcmPresent", "dtcmPresent", "vtorPresent"
-    ]
+    }
+    __slots__ = props
+
 
 class SvdPeripheral(SvdElement):
     """SVD Peripherals Level
@@ -151,14 +333,15 @@ class SvdPeripheral(SvdElement):
         "appendToName", "headerStructName", "disableCondition", "baseAddress",
         "size", "access", "protection", "resetValue", "resetMask"
     ]
-    props_to_integer = [
+    props_to_integer = {
         "dim", "dimIncrement", "baseAddress", "size", "resetValue",
         "resetMask"
-    ]
+    }
+    __slots__ = props + ["registers", "interrupts", "addressBlock"]
 
     def from_element(self, element, defaults={}):
         SvdElement.from_element(self, element, defaults)
-        self.registers = []
+        self.registers = RegisterList()
         self.interrupts = []
         self.addressBlock = None
 
@@ -203,10 +386,11 @@ class SvdRegister(SvdElement):
         "resetValue", "resetMask", "dataType", "modifiedWriteValues",
         "readAction"
     ]
-    props_to_integer = [
+    props_to_integer = {
         "dim", "dimIncrement", "addressOffset", "size", "resetValue",
         "resetMask"
-    ]
+    }
+    __slots__ = props + ["fields", "writeConstraint"]
 
     def from_element(self, element, defaults={}):
         SvdElement.from_element(self, element, defaults)
@@ -244,28 +428,123 @@ class SvdRegister(SvdElement):
         contains the register itself unchanged. In case the register
         name looks like a C array, the returned list contains the register
         itself, where nothing else than the '%s' placeholder in it's name
-        has been replaced with value of the dim element.
+        has been replaced with value of the dim element. Otherwise a lazy
+        sequence of the registers in the array is returned.
         """
         if self.dim is None:
             return [self]
         if self.name.endswith("[%s]"):  # C array like
             self.name = self.name.replace("%s", str(self.dim))
             return [self]
+        return SvdRegisterArray(self)
 
-        registers = []
-        for offset, index in enumerate(self.dimIndex):
-            reg = self.copy()
-            reg.name = self.name.replace("%s", str(index))
-            reg.addressOffset += offset * reg.dimIncrement
 
-            reg.fields = [field.copy() for field in reg.fields]
-            for field in reg.fields:
-                field.parent = reg
+class SvdRegisterArray(Sequence):
+    """Folded dim register array
 
-            reg.dim = reg.dimIndex = reg.dimIncrement = None  # Dimensionless
-            registers.append(reg)
+    The registers of the array are created on demand when accessed. They
+    share everything but the name and address offset with the dim register.
+    """
 
-        return registers
+    def __init__(self, register):
+        self.register = register
+
+    def __len__(self):
+        return len(self.register.dimIndex)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("register array index out of range")
+        reg = self.register
+        return FoldedRegister(
+            reg,
+            reg.name.replace("%s", str(reg.dimIndex[i])),
+            reg.addressOffset + i * reg.dimIncrement
+        )
+
+
+class FoldedRegister(SvdRegister):
+    """Register of a folded dim register array
+
+    Attributes other than the name and address offset are read from the
+    dim register, except that the register is dimensionless. The fields
+    are views of the fields of the dim register, see FoldedField.
+    """
+    __slots__ = ["base"]
+    _dimensionless = frozenset(["dim", "dimIndex", "dimIncrement"])
+
+    def __init__(self, base, name, addressOffset):
+        self.base = base
+        self.name = name
+        self.addressOffset = addressOffset
+
+    def __getattr__(self, name):
+        if name in self._dimensionless:
+            return None
+        if name == "fields":  # Created on first access
+            self.fields = [FoldedField(f, self) for f in self.base.fields]
+            return self.fields
+        if name == "base" or name not in self._attribute_set:
+            return SvdElement.__getattr__(self, name)
+        return getattr(self.base, name)
+
+    def asdict(self):
+        attributes = self.base.asdict()
+        attributes.update(dict.fromkeys(self._dimensionless))
+        attributes.update(name=self.name, addressOffset=self.addressOffset,
+                          fields=self.fields)
+        return attributes
+
+
+class RegisterList(Sequence):
+    """List of the registers and clusters of a peripheral or cluster
+
+    Folded register arrays are kept as lazy sequences and flattened only
+    when accessed.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.ends = []  # Cumulative length after each chunk
+
+    def append(self, item):
+        self.extend([item])
+
+    def extend(self, items):
+        if isinstance(items, SvdRegisterArray):
+            self.chunks.append(items)
+            self.ends.append(len(self) + len(items))
+            return
+        if not self.chunks or not isinstance(self.chunks[-1], list):
+            self.chunks.append([])
+            self.ends.append(len(self))
+        self.chunks[-1].extend(items)
+        self.ends[-1] += len(items)
+
+    def __len__(self):
+        return self.ends[-1] if self.ends else 0
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("register list index out of range")
+        n = bisect_right(self.ends, i)
+        start = self.ends[n-1] if n else 0
+        return self.chunks[n][i - start]
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield from chunk
+
+    def __repr__(self):
+        return repr(list(self))
 
 
 class Cluster(SvdElement):
@@ -279,11 +558,12 @@ class Cluster(SvdElement):
         "registers", "derivedFrom", "dim", "dimIncrement", "dimIndex", "name",
         "description", "alternateCluster", "headerStructName", "addressOffset"
     ]
-    props_to_integer = ["addressOffset", "dim", "dimIncrement"]
+    props_to_integer = {"addressOffset", "dim", "dimIncrement"}
+    __slots__ = props
 
     def from_element(self, element, defaults={}):
         SvdElement.from_element(self, element, {})
-        self.registers = []
+        self.registers = RegisterList()
 
         # TODO: Should work like Register.to_array(), if there's self.dim
         self.name = self.name.replace("%s", str(self.dim))
@@ -310,7 +590,8 @@ class SvdField(SvdElement):
         "lsb", "msb", "bitRange", "access", "modifiedWriteValues",
         "readAction"
     ]
-    props_to_integer = ["bitOffset", "bitWidth", "lsb", "msb"]
+    props_to_integer = {"bitOffset", "bitWidth", "lsb", "msb"}
+    __slots__ = props + ["enumeratedValues", "writeConstraint"]
 
     def from_element(self, element, defaults={}):
         SvdElement.from_element(self, element, defaults)
@@ -350,6 +631,29 @@ class SvdField(SvdElement):
             pass
 
 
+class FoldedField(SvdField):
+    """Field of a folded register
+
+    Attributes other than the parent are read from the field of the dim
+    register.
+    """
+    __slots__ = ["base"]
+
+    def __init__(self, base, parent):
+        self.base = base
+        self.parent = parent
+
+    def __getattr__(self, name):
+        if name == "base" or name not in self._attribute_set:
+            return SvdElement.__getattr__(self, name)
+        return getattr(self.base, name)
+
+    def asdict(self):
+        attributes = self.base.asdict()
+        attributes.update(parent=self.parent)
+        return attributes
+
+
 class SvdEnumeratedValue(SvdElement):
     """SVD Enumerated values Level
 
@@ -357,22 +661,26 @@ class SvdEnumeratedValue(SvdElement):
     integers and an identifier string.
     """
     props = ["derivedFrom", "name", "description", "value", "isDefault"]
-    props_to_integer = ["value"]
+    props_to_integer = {"value"}
+    __slots__ = props
 
 
 class SvdInterrupt(SvdElement):
     props = ["name", "description", "value"]
-    props_to_integer = ["value"]
+    props_to_integer = {"value"}
+    __slots__ = props
 
 
 class SvdAddressBlock(SvdElement):
     props = ["addressBlock", "offset", "size", "usage", "protection"]
-    props_to_integer = ["offset", "size"]
+    props_to_integer = {"offset", "size"}
+    __slots__ = props
 
 
 class SvdWriteConstraint(SvdElement):
     props = ["writeAsRead", "useEnumeratedValues"]
-    props_to_boolean = ["writeAsRead", "useEnumeratedValues"]
+    props_to_boolean = {"writeAsRead", "useEnumeratedValues"}
+    __slots__ = props + ["range"]
 
     def from_element(self, element, defaults={}):
         SvdElement.from_element(self, element, defaults)
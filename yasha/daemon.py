@@ -0,0 +1,281 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015-2021 Kim Blomqvist
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+# Only the standard library is imported at the module level, so that the
+# client doesn't pay the start-up cost of Click, Jinja and the parsers.
+import io
+import os
+import sys
+import json
+import socket
+import struct
+
+SERVER_ENV = 'YASHA_SERVER'
+
+EXIT = 0
+STDOUT = 1
+STDERR = 2
+STDIN = 3
+
+# Number of the worker processes, so that parallel builds don't wait for
+# each other. Renders mostly wait for the commands and files they read.
+WORKERS = max(4, os.cpu_count() or 1)
+
+_header = struct.Struct('!BI')
+
+
+def send(sock, channel, data=b''):
+    sock.sendall(_header.pack(channel, len(data)) + data)
+
+
+def recv(sock):
+    def read(size):
+        data = b''
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise EOFError('Connection closed by the peer')
+            data += chunk
+        return data
+    channel, size = _header.unpack(read(_header.size))
+    return channel, read(size)
+
+
+class Channel(io.RawIOBase):
+    """Writable stream which sends the data to the client"""
+
+    def __init__(self, sock, channel):
+        self.sock = sock
+        self.channel = channel
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        send(self.sock, self.channel, bytes(data))
+        return len(data)
+
+
+def reads_stdin(argv):
+    """Returns True if a template or variable file is read from STDIN"""
+    for prev, arg in zip([None] + argv, argv):
+        if arg == '-' and prev not in ('-o', '--output'):
+            return True
+    return False
+
+
+def starts_server(argv):
+    """Returns True if the call starts a daemon, i.e. has option --serve"""
+    return any(arg == '--serve' or arg.startswith('--serve=') for arg in argv)
+
+
+def connect(address, argv):
+    """Runs Yasha in the daemon listening the address and returns the
+    exit code. Raises FileNotFoundError or ConnectionRefusedError if the
+    daemon is not available.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(address)
+        request = dict(argv=argv, cwd=os.getcwd(), env=dict(os.environ))
+        send(sock, STDIN, json.dumps(request).encode('utf-8'))
+        stdin = sys.stdin.buffer.read() if reads_stdin(argv) else b''
+        send(sock, STDIN, stdin)
+
+        streams = {STDOUT: sys.stdout.buffer, STDERR: sys.stderr.buffer}
+        while True:
+            channel, data = recv(sock)
+            if channel == EXIT:
+                return int(data)
+            streams[channel].write(data)
+            streams[channel].flush()
+    finally:
+        sock.close()
+
+
+def handle(sock, cli):
+    """Runs the command-line call requested by the client"""
+    import traceback
+    import jinja2.defaults
+    from . import yasha
+    from . import filters
+    from .tests import TESTS
+    from .filters import FILTERS
+    from .classes import CLASSES
+    from .parsers import PARSERS
+
+    _, request = recv(sock)
+    _, stdin = recv(sock)
+    request = json.loads(request.decode('utf-8'))
+
+    # Extension files modify the global state, so save it for restoring
+    state = (dict(TESTS), dict(FILTERS), dict(PARSERS), list(CLASSES))
+    defaults = {x: getattr(jinja2.defaults, x) for x in dir(jinja2.defaults)
+                if x.isupper()}
+    encoding = yasha.ENCODING
+    environ = dict(os.environ)
+    cwd = os.getcwd()
+    streams = (sys.stdin, sys.stdout, sys.stderr)
+
+    stdin = io.BytesIO(stdin)
+    stdin.name = '<stdin>'
+    stdout = io.BufferedWriter(Channel(sock, STDOUT))
+    stderr = io.BufferedWriter(Channel(sock, STDERR))
+    sys.stdin = io.TextIOWrapper(stdin)
+    sys.stdout = io.TextIOWrapper(stdout, encoding='utf-8')
+    sys.stderr = io.TextIOWrapper(stderr, encoding='utf-8')
+
+    try:
+        os.environ.clear()
+        os.environ.update(request['env'])
+        os.environ.pop(SERVER_ENV, None)  # Nested calls would deadlock
+        os.chdir(request['cwd'])
+        cli.main(args=request['argv'], prog_name='yasha')
+        code = 0
+    except SystemExit as e:
+        if e.code is None:
+            code = 0
+        elif isinstance(e.code, int):
+            code = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            code = 1
+    except Exception:
+        traceback.print_exc()
+        code = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        except OSError:
+            pass  # Client went away
+        sys.stdin, sys.stdout, sys.stderr = streams
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(environ)
+        yasha.ENCODING = encoding
+        filters._shell_results.clear()  # Cached within the call only
+        for name, value in defaults.items():
+            setattr(jinja2.defaults, name, value)
+        for table, saved in zip((TESTS, FILTERS, PARSERS), state):
+            table.clear()
+            table.update(saved)
+        CLASSES[:] = state[3]
+
+    send(sock, EXIT, str(code).encode('ascii'))
+
+
+def work(server, cli):
+    """Handles the requests accepted from the server socket until
+    interrupted. Run in the forked worker processes.
+    """
+    try:
+        while True:
+            sock, _ = server.accept()
+            try:
+                handle(sock, cli)
+            except (OSError, EOFError):
+                pass  # Client went away
+            finally:
+                sock.close()
+    except KeyboardInterrupt:
+        pass
+
+
+def serve(address):
+    """Serves the clients connecting to the Unix domain socket address.
+    The requests are handled concurrently by WORKERS forked processes,
+    each of which keeps the templates, variable files and extension files
+    loaded between the requests.
+    """
+    from click import ClickException
+    from . import cli as yasha_cli
+    from .cli import cli
+
+    yasha_cli.KEEP_VARIABLES = True
+
+    if not hasattr(socket, 'AF_UNIX'):
+        raise ClickException('Unix domain sockets are not supported')
+
+    if os.path.exists(address):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(address)
+        except OSError:
+            os.unlink(address)  # Stale socket
+        else:
+            msg = "Yasha daemon is already serving at '{}'"
+            raise ClickException(msg.format(address))
+        finally:
+            probe.close()
+
+    import signal
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:  # Worker never returns to the code below
+            try:
+                work(server, cli)
+            finally:
+                os._exit(0)
+        workers.add(pid)
+
+    workers = set()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(address)
+        os.chmod(address, 0o600)
+        server.listen(64)
+        for _ in range(WORKERS):
+            spawn()
+        while True:
+            pid, _ = os.wait()
+            workers.discard(pid)
+            spawn()  # Replace the worker which died
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+        for pid in workers:
+            os.waitpid(pid, 0)
+        server.close()
+        os.unlink(address)
+
+
+def main():
+    """Entry point of the command-line tool. Forwards the call to the
+    daemon given by YASHA_SERVER environment variable if available.
+    """
+    argv = sys.argv[1:]
+    address = os.environ.get(SERVER_ENV)
+    if address and not starts_server(argv):
+        try:
+            sys.exit(connect(address, argv))
+        except (FileNotFoundError, ConnectionRefusedError):
+            pass  # Daemon not running, render in this process
+
+    from .cli import cli
+    cli(prog_name='yasha')
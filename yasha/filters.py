@@ -24,16 +24,73 @@ THE SOFTWARE.
 
 import os
 import sys
-import subprocess
 
 from click import ClickException
 from .yasha import ENCODING
 
+# Set via --shell-cache, --shell-cache-ttl and --shell-cache-env
+SHELL_CACHE = False
+SHELL_CACHE_TTL = None  # Seconds, results are cached on disk if --cache-dir
+SHELL_CACHE_ENV = ()  # Names of the environment variables in the cache key
+
+SHELL_PREFETCH = False  # Set via --shell-prefetch
+
+_shell_results = dict()  # Cached results of this process by command
+_prefetched = dict()  # Results of the prefetched commands by command
+
+def shell_cache_key(cmd, key):
+    """
+    Returns the key of the cached command result. The key consists of the
+    command, the working directory, the selected environment variables
+    and the given key.
+    """
+    from . import cache
+    env = tuple((name, os.environ.get(name)) for name in SHELL_CACHE_ENV)
+    return cache.digest(repr((cmd, os.getcwd(), env, key)))
+
+def load_shell_result(key):
+    """Returns the cached command result, or None if not cached or expired"""
+    import time
+    from . import cache
+
+    timestamp, result = _shell_results.get(key, (None, None))
+    if timestamp is None and SHELL_CACHE_TTL is not None:
+        timestamp, result = cache.load('shell', key, (None, None))
+    if timestamp is None:
+        return None
+    if (SHELL_CACHE_TTL is not None
+            and time.time() - timestamp >= SHELL_CACHE_TTL):
+        return None
+    return result
+
+def dump_shell_result(key, result):
+    import time
+    from . import cache
+
+    now = time.time()
+    _shell_results[key] = (now, result)
+    if SHELL_CACHE_TTL is not None:
+        cache.dump('shell', key, (now, result))
+
+def check_result(cmd, result, check):
+    if check and result.returncode:
+        errno = result.returncode
+        error = (result.stderr or b'').decode().strip()
+        msg = "Command '{}' returned non-zero exit status {}\n{}"
+        raise ClickException(msg.format(cmd, errno, error))
+    return result
+
+def timed_out(cmd, timeout):
+    msg = "Command '{}' timed out after waiting for {} seconds"
+    return ClickException(msg.format(cmd, timeout))
+
 def do_env(value, default=None):
     return os.environ.get(value, default)
 
-def do_subprocess(cmd, stdout=True, stderr=True, check=True, timeout=2):
+def do_subprocess(cmd, stdout=True, stderr=True, check=True, timeout=2,
+                  cache=None):
     assert sys.version_info >= (3,5)
+    import subprocess
     kwargs = dict(
         stdout=subprocess.PIPE if stdout else None,
         stderr=subprocess.PIPE if stderr else None,
@@ -42,27 +99,192 @@ def do_subprocess(cmd, stdout=True, stderr=True, check=True, timeout=2):
         timeout=timeout,
     )
 
+    def run():
+        try:
+            return _prefetched.pop((cmd, stdout, stderr, timeout))
+        except KeyError:
+            return subprocess.run(cmd, **kwargs)
+
     try:
-        result = subprocess.run(cmd, **kwargs)
+        if SHELL_CACHE if cache is None else cache:
+            key = shell_cache_key(cmd, (stdout, stderr))
+            result = load_shell_result(key)
+            if result is None:
+                result = run()
+                dump_shell_result(key, result)
+        else:
+            result = run()
     except subprocess.TimeoutExpired:
-        msg = "Command '{}' timed out after waiting for {} seconds"
-        raise ClickException(msg.format(cmd, timeout))
+        raise timed_out(cmd, timeout)
 
-    if check and result.returncode:
-        errno = result.returncode
-        error = result.stderr.decode().strip()
-        msg = "Command '{}' returned non-zero exit status {}\n{}"
-        raise ClickException(msg.format(cmd, errno, error))
+    return check_result(cmd, result, check)
 
-    return result
+def do_shell(cmd, strip=True, check=True, timeout=2, cache=None):
+    result = do_subprocess(cmd, stderr=False, check=check, timeout=timeout,
+                           cache=cache)
+    if not strip:
+        return result.stdout.decode(encoding=ENCODING)
+    else:
+        return result.stdout.decode(encoding=ENCODING).strip()
 
-def do_shell(cmd, strip=True, check=True, timeout=2):
-    result = do_subprocess(cmd, stderr=False, check=check, timeout=timeout)
+async def do_subprocess_async(cmd, stdout=True, stderr=True, check=True,
+                              timeout=2, cache=None):
+    """Variant of do_subprocess for async mode"""
+    import asyncio
+    import subprocess
+
+    async def run():
+        try:
+            return _prefetched.pop((cmd, stdout, stderr, timeout))
+        except KeyError:
+            pass
+        process = await asyncio.create_subprocess_shell(
+            cmd,
+            stdout=subprocess.PIPE if stdout else None,
+            stderr=subprocess.PIPE if stderr else None,
+        )
+        try:
+            out, err = await asyncio.wait_for(process.communicate(), timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise timed_out(cmd, timeout)
+        return subprocess.CompletedProcess(cmd, process.returncode, out, err)
+
+    if SHELL_CACHE if cache is None else cache:
+        key = shell_cache_key(cmd, (stdout, stderr))
+        result = load_shell_result(key)
+        if result is None:
+            result = await run()
+            dump_shell_result(key, result)
+    else:
+        result = await run()
+
+    return check_result(cmd, result, check)
+
+async def do_shell_async(cmd, strip=True, check=True, timeout=2, cache=None):
+    """Variant of do_shell for async mode"""
+    result = await do_subprocess_async(cmd, stderr=False, check=check,
+                                       timeout=timeout, cache=cache)
     if not strip:
         return result.stdout.decode(encoding=ENCODING)
     else:
         return result.stdout.decode(encoding=ENCODING).strip()
 
+def find_shell_commands(environment, source):
+    """
+    Returns the shell and subprocess filter calls with constant arguments
+    found in the template source, as (cmd, stdout, stderr, timeout) tuples.
+    """
+    import inspect
+    from jinja2 import nodes
+
+    commands = []
+    for node in environment.parse(source).find_all(nodes.Filter):
+        func = environment.filters.get(node.name)
+        func = getattr(func, '__wrapped__', func)
+        func = SYNC_VARIANTS.get(func, func)
+        if func not in (do_shell, do_subprocess) or node.node is None:
+            continue
+        if node.dyn_args or node.dyn_kwargs:
+            continue
+        try:
+            cmd = node.node.as_const()
+            args = [arg.as_const() for arg in node.args]
+            kwargs = {kw.key: kw.value.as_const() for kw in node.kwargs}
+            call = inspect.signature(func).bind(cmd, *args, **kwargs)
+        except Exception:  # Not constant, or invalid arguments
+            continue
+        call.apply_defaults()
+        call = call.arguments
+        if func is do_shell:
+            call.update(stdout=True, stderr=False)
+        if call['stdout'] and isinstance(cmd, str):
+            command = (cmd, call['stdout'], call['stderr'], call['timeout'])
+            commands.append(command)
+    return commands
+
+def prefetch(commands):
+    """
+    Runs the (cmd, stdout, stderr, timeout) commands concurrently. Each
+    result is then used by the next shell or subprocess filter call of
+    the same command instead of running it again. Commands which results
+    are found in the shell cache are not run.
+    """
+    import subprocess
+    from concurrent.futures import ThreadPoolExecutor
+
+    def run(command):
+        cmd, stdout, stderr, timeout = command
+        try:
+            return subprocess.run(
+                cmd,
+                stdout=subprocess.PIPE if stdout else None,
+                stderr=subprocess.PIPE if stderr else None,
+                shell=True,
+                check=False,
+                timeout=timeout,
+            )
+        except subprocess.TimeoutExpired:
+            return None  # Timed out again when run by the filter
+
+    def cached(command):
+        cmd, stdout, stderr, timeout = command
+        key = shell_cache_key(cmd, (stdout, stderr))
+        return SHELL_CACHE and load_shell_result(key) is not None
+
+    commands = [
+        c for c in set(commands) if c not in _prefetched and not cached(c)
+    ]
+    if not commands:
+        return
+    with ThreadPoolExecutor(max_workers=len(commands)) as pool:
+        for command, result in zip(commands, pool.map(run, commands)):
+            if result is not None:
+                _prefetched[command] = result
+
+def volatile(func):
+    """
+    Wraps the filter to be called on render. Otherwise Jinja may call it
+    already when compiling the template, in case of constant arguments,
+    so the result would end up in the cached templates.
+    """
+    import functools
+    try:
+        from jinja2 import pass_context
+    except ImportError:  # Jinja 2.11
+        from jinja2 import contextfilter as pass_context
+
+    @pass_context
+    @functools.wraps(func)
+    def filter(context, *args, **kwargs):
+        return func(*args, **kwargs)
+    return filter
+
+def jinja_filters(filters, enable_async=False):
+    """
+    Returns the filters to be loaded into Jinja environment. The async
+    variants are used in async mode, and the volatile filters are wrapped
+    to be called on render.
+    """
+    if enable_async:
+        filters = {name: ASYNC_VARIANTS.get(f, f)
+                   for name, f in filters.items()}
+    return {name: volatile(f) if f in VOLATILE else f
+            for name, f in filters.items()}
+
+ASYNC_VARIANTS = {
+    do_shell: do_shell_async,
+    do_subprocess: do_subprocess_async,
+}
+
+SYNC_VARIANTS = {v: k for k, v in ASYNC_VARIANTS.items()}
+
+# Filters whose results depend on something else than the arguments
+VOLATILE = frozenset([
+    do_env, do_shell, do_subprocess, do_shell_async, do_subprocess_async,
+])
+
 FILTERS = {
     'env': do_env,
     'shell': do_shell,
@@ -26,16 +26,43 @@ import sys
 
 from .yasha import ENCODING
 
+# Set via --svd-peripherals and --svd-depth, see SVDFile.parse()
+SVD_PERIPHERALS = None
+SVD_DEPTH = None
+
+YAML_LOADER = 'auto'  # Set via --yaml-loader
+CSV_MODE = 'list'  # Set via --csv-mode
+
+def options():
+    """Returns the options affecting the results of the built-in parsers"""
+    return (SVD_PERIPHERALS, SVD_DEPTH, CSV_MODE)
+
 def parse_json(file):
     import json
     assert file.name.endswith('.json')
     variables = json.loads(file.read().decode(ENCODING))
     return variables if variables else dict()
 
+def yaml_loader(name=None):
+    """Returns the safe YAML loader class by the name: 'c' for the libyaml
+    based loader, 'python' for the pure Python loader or 'auto' for the
+    former if PyYAML is built with libyaml.
+    """
+    import yaml
+    name = name or YAML_LOADER
+    if name != 'python':
+        try:
+            return yaml.CSafeLoader
+        except AttributeError:  # PyYAML built without libyaml
+            if name == 'c':
+                from click import ClickException
+                raise ClickException("PyYAML is built without libyaml")
+    return yaml.SafeLoader
+
 def parse_yaml(file):
     import yaml
     assert file.name.endswith(('.yaml', '.yml'))
-    variables = yaml.safe_load(file)
+    variables = yaml.load(file, Loader=yaml_loader())
     return variables if variables else dict()
 
 def parse_toml(file):
@@ -52,15 +79,28 @@ def parse_xml(file):
 
 def parse_svd(file):
     # TODO: To be moved into its own repo
+    from . import cache
+    from .yasha import __version__
     from .cmsis import SVDFile
+
+    if cache.DIRECTORY is not None:
+        key = cache.file_digest(file, 'svd', __version__, repr(options()))
+        variables = cache.load('svd', key)
+        if variables is not None:
+            return variables
+
     svd = SVDFile(file)
-    svd.parse()
-    return {
+    svd.parse(SVD_PERIPHERALS, SVD_DEPTH)
+    variables = {
         "cpu": svd.cpu,
         "device": svd.device,
         "peripherals": svd.peripherals,
     }
 
+    if cache.DIRECTORY is not None:
+        cache.dump('svd', key, variables)
+    return variables
+
 
 def parse_ini(file):
     from configparser import ConfigParser
@@ -74,17 +114,115 @@ def parse_ini(file):
     return result
 
 
+class CsvRows(object):
+    """
+    Re-iterable sequence of the rows of a CSV file. The rows are read from
+    the file on every iteration, so only the current row is kept in memory.
+    """
+
+    def __init__(self, filename, header):
+        self.filename = filename
+        self.header = header
+        self._length = None
+
+    def __iter__(self):
+        from csv import reader, DictReader
+        with open(self.filename, encoding='utf-8', errors='replace') as f:
+            if self.header:
+                for row in DictReader(f):
+                    yield dict(row)
+            else:
+                yield from reader(f)
+
+    def __len__(self):
+        if self._length is None:
+            self._length = sum(1 for _ in self)
+        return self._length
+
+    def __bool__(self):
+        for _ in self:
+            return True
+        return False
+
+    def __repr__(self):
+        return '<CsvRows {!r}>'.format(self.filename)
+
+
+def csv_kind(cell, kind):
+    """Returns int, float or str, whichever of kind and the next kinds
+    can represent the CSV cell"""
+    while kind is not str:
+        try:
+            if kind is int and not -(1 << 63) <= int(cell) < (1 << 63):
+                raise OverflowError  # Doesn't fit in int64 array
+            kind(cell)
+            return kind
+        except (ValueError, OverflowError):
+            kind = float if kind is int else str
+    return kind
+
+
+def csv_columns(content, header):
+    """
+    Returns the columns of the CSV file, keyed by the header if the first
+    row is a header. The columns are arrays of integers or floats, if all
+    the cells are numbers, and otherwise lists of strings. NumPy arrays are
+    returned if NumPy is available. The file is read twice, first to find
+    out the column types, so that the cells don't need to be kept as
+    strings in the meantime.
+    """
+    from array import array
+    from csv import reader
+
+    rows = reader(content)
+    names = next(rows, []) if header else []
+    kinds = [int] * len(names)
+    for count, row in enumerate(rows):
+        if len(row) > len(kinds):  # Missing from the previous rows
+            kinds += [str if count else int] * (len(row) - len(kinds))
+        kinds[len(row):] = [str] * (len(kinds) - len(row))
+        for i, cell in enumerate(row):
+            kinds[i] = csv_kind(cell, kinds[i])
+
+    content.seek(0)
+    rows = reader(content)
+    if header:
+        next(rows, None)
+    typecodes = {int: 'q', float: 'd'}
+    columns = [array(typecodes[k]) if k in typecodes else [] for k in kinds]
+    for row in rows:
+        row += [''] * (len(kinds) - len(row))
+        for kind, column, cell in zip(kinds, columns, row):
+            column.append(kind(cell))
+
+    try:
+        import numpy
+    except ImportError:
+        pass
+    else:
+        columns = [numpy.asarray(c) if isinstance(c, array) else c
+                   for c in columns]
+    if header:
+        return dict(zip(names, columns))
+    return columns
+
+
 def parse_csv(file):
     from csv import reader, DictReader, Sniffer
     from io import TextIOWrapper
-    from os.path import basename, splitext
+    from os.path import abspath, basename, splitext
     assert file.name.endswith('.csv')
     name = splitext(basename(file.name))[0]  # get the filename without the extension
     content = TextIOWrapper(file, encoding='utf-8', errors='replace')
     sample = content.read(1024)
     content.seek(0)
+    header = Sniffer().has_header(sample)
+    if CSV_MODE == 'stream':
+        return {name: CsvRows(abspath(file.name), header)}
+    if CSV_MODE == 'columns':
+        return {name: csv_columns(content, header)}
     csv = list()
-    if Sniffer().has_header(sample):
+    if header:
         for row in DictReader(content):
             csv.append(dict(row))
     else:
@@ -93,6 +231,44 @@ def parse_csv(file):
     return {name: csv}
 
 
+def parse_cached(parse, file):
+    """Returns the variables parsed from the file by the given parser.
+    The results of the built-in parsers are cached on disk if the cache
+    directory is set. The cache entries are keyed by the file content,
+    which is hashed only if the file path, size or mtime changes.
+    """
+    import os
+    from . import cache
+    from . import yasha
+
+    if cache.DIRECTORY is None or parse not in CACHEABLE:
+        return parse(file)
+    if parse is parse_csv and CSV_MODE == 'stream':
+        return parse(file)  # Rows are read from the file on render
+
+    stat = os.stat(file.name)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    parts = (parse.__name__, yasha.ENCODING, yasha.__version__,
+             repr(options()))
+    path = os.path.realpath(file.name)
+    index = cache.digest(path, *parts)
+
+    cached_stamp, key = cache.load('variables-index', index, (None, None))
+    if cached_stamp != stamp:
+        key = cache.file_digest(file, path, *parts)
+        cache.dump('variables-index', index, (stamp, key))
+
+    variables = cache.load('variables', key)
+    if variables is None:
+        variables = parse(file)
+        cache.dump('variables', key, variables)
+    return variables
+
+
+# SVD files are cached by parse_svd() itself
+CACHEABLE = (parse_json, parse_yaml, parse_toml, parse_xml, parse_ini,
+             parse_csv)
+
 PARSERS = {
     '.json': parse_json,
     '.yaml': parse_yaml,
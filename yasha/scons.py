@@ -24,35 +24,52 @@ THE SOFTWARE.
 
 import os
 from SCons.Builder import BuilderBase
-from click.testing import CliRunner
 
 from . import cli
 
 
+def dependencies(args):
+    """Returns the dependencies of the template rendered by the given
+    command-line arguments, e.g. ['-v', 'foo.yaml', 'foo.c.j2'].
+    """
+    with cli.cli.make_context('yasha', list(args)) as ctx:
+        params = ctx.params
+        extensions = params['extensions']
+        return cli.dependencies(
+            params['template'].name,
+            variables=[f.name for f in params['variables']],
+            extensions=extensions.name if extensions else None,
+            include_path=params['include_path'],
+            no_variable_file=params['no_variable_file'],
+            no_extension_file=params['no_extension_file'],
+        )
+
+
 class Builder(BuilderBase):
 
     def __init__(self, action="yasha -o $TARGET $SOURCE"):
+        scanned = dict()  # Dependencies by the source node signature
+
         def scan(node, env, path):
             src = str(node.srcnode())
             src_dir = os.path.dirname(src)
             variant_dir = os.path.dirname(str(node))
 
-            cmd = action.replace('$SOURCE', src)
-            cmd = ['-M'] + cmd.split()[1:]
+            # Split before substituting, the source path may have spaces
+            args = [a.replace('$SOURCE', src) for a in action.split()[1:]]
 
             try: # Remove $TARGET from action
-                index = cmd.index('-o')
-                del cmd[index]
-                del cmd[index]
+                index = args.index('-o')
+                del args[index]
+                del args[index]
             except ValueError:
                 pass
 
-            runner = CliRunner()
-            result = runner.invoke(cli.cli, cmd)
-
-            deps = result.output[:-1].split(" ")[2:]
-            deps = [d.replace(src_dir, variant_dir) for d in deps]
+            key = (src, node.get_csig(), tuple(args))
+            if key not in scanned:
+                scanned[key] = dependencies(args)
 
+            deps = [d.replace(src_dir, variant_dir) for d in scanned[key]]
             return env.File(deps)
 
         def emit(target, source, env):
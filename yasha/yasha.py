@@ -25,12 +25,31 @@ THE SOFTWARE.
 import os
 import ast
 import csv
-import jinja2 as jinja
 
 __version__ = "dev"
 
 ENCODING = 'utf-8'
 EXTENSION_FILE_FORMATS = ('.py', '.yasha', '.j2ext', '.jinja-ext')
+TEMPLATE_FILE_FORMATS = ('.j2', '.jinja', '.jinja2')
+
+_listings = dict()  # Sorted directory listings by path
+
+def list_directory(path):
+    """
+    Returns the sorted list of file names in the directory. The listing
+    is reused as long as the modification time of the directory stays.
+    """
+    import time
+    stat = os.stat(path)
+    if _listings.get(path, (None,))[0] == stat.st_mtime_ns:
+        return _listings[path][1]
+    listing = sorted(os.listdir(path))
+    # The directory may still change within the file system's timestamp
+    # resolution without its modification time changing
+    if time.time() - stat.st_mtime > 2:
+        _listings[path] = (stat.st_mtime_ns, listing)
+    return listing
+
 
 def find_template_companion(template, extension='', check=True):
     """
@@ -53,7 +72,7 @@ def find_template_companion(template, extension='', check=True):
 
     while True:
 
-        for file in sorted(os.listdir(current_path)):
+        for file in list_directory(current_path):
             if not file.startswith(token):
                 continue
             if not file.endswith(extension):
@@ -76,16 +95,41 @@ def find_template_companion(template, extension='', check=True):
         current_path = os.path.split(current_path)[0]
 
 
-def find_referenced_templates(template, search_path):
+_referenced = dict()  # Stamp, digest and referenced templates by file path
+
+def referenced_templates(source):
     """
-    Returns a list of files which can be either {% imported %},
-    {% extended %} or {% included %} within a template.
+    Returns the names of the templates referenced within the template source.
     """
     from jinja2 import Environment, meta
-    env = Environment()
-    ast = env.parse(template.read())
-    referenced_templates = list(meta.find_referenced_templates(ast))
+    if isinstance(source, bytes):
+        source = source.decode(ENCODING)
+    ast = Environment().parse(source)
+    return [t for t in meta.find_referenced_templates(ast) if t is not None]
+
+
+def referenced_templates_of_file(filename):
+    """
+    Returns the names of the templates referenced within the template file.
+    The file is parsed only once per process, unless modified.
+    """
+    stat = os.stat(filename)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    if _referenced.get(filename, (None,))[0] != stamp:
+        import hashlib
+        with open(filename, 'rb') as f:
+            source = f.read()
+        digest = hashlib.sha1(source).hexdigest()
+        _referenced[filename] = (stamp, digest, referenced_templates(source))
+    return _referenced[filename][2]
+
 
+def find_referenced_templates(template, search_path):
+    """
+    Returns a list of files which can be either {% imported %},
+    {% extended %} or {% included %} within a template, or within
+    the referenced templates in turn.
+    """
     def realpath(tpl):
         for path in search_path:
             t = os.path.realpath(os.path.join(path, tpl))
@@ -93,7 +137,23 @@ def find_referenced_templates(template, search_path):
                 return t
         return None
 
-    return [realpath(t) for t in referenced_templates if t is not None]
+    filename = os.path.realpath(template.name)
+    if os.path.isfile(filename):
+        referenced = referenced_templates_of_file(filename)
+    else:  # E.g. '<stdin>'
+        referenced = referenced_templates(template.read())
+
+    visited = {filename}
+    found = []
+    pending = [realpath(t) for t in referenced]
+    while pending:
+        t = pending.pop(0)
+        if t is None or t in visited:
+            continue
+        visited.add(t)
+        found.append(t)
+        pending += [realpath(x) for x in referenced_templates_of_file(t)]
+    return found
 
 
 def parse_cli_variables(args):
@@ -127,9 +187,98 @@ def parse_cli_variables(args):
     return variables
 
 
+_BytecodeCache = None  # Defined on first use, see bytecode_cache()
+
+def bytecode_cache(directory):
+    """
+    Returns a file system bytecode cache which keys the cached templates
+    not only by their name but also by the Jinja settings affecting the
+    compiled code, e.g. the template syntax which may be redefined via
+    extension file, and by the filters and tests. The template source
+    hash is validated by Jinja on every load.
+    """
+    global _BytecodeCache
+    if _BytecodeCache is None:
+        from jinja2 import FileSystemBytecodeCache
+        from jinja2.bccache import Bucket
+
+        class BytecodeCache(FileSystemBytecodeCache):
+
+            def get_bucket(self, environment, name, filename, source):
+                key = self.get_cache_key(name, filename)
+                settings = repr(environment_settings(environment))
+                key = self.get_cache_key(key, settings)
+                checksum = self.get_source_checksum(source)
+                bucket = Bucket(environment, key, checksum)
+                self.load_bytecode(bucket)
+                return bucket
+
+        _BytecodeCache = BytecodeCache
+
+    os.makedirs(directory, exist_ok=True)
+    return _BytecodeCache(directory)
+
+
+def environment_settings(env):
+    """
+    Returns the Jinja environment settings which affect the way how
+    the templates are compiled.
+    """
+    return (
+        env.block_start_string,
+        env.block_end_string,
+        env.variable_start_string,
+        env.variable_end_string,
+        env.comment_start_string,
+        env.comment_end_string,
+        env.line_statement_prefix,
+        env.line_comment_prefix,
+        env.trim_blocks,
+        env.lstrip_blocks,
+        env.newline_sequence,
+        env.keep_trailing_newline,
+        env.is_async,
+        tuple(sorted(env.extensions)),
+        functions_digest(env.filters),
+        functions_digest(env.tests),
+    )
+
+
+def functions_digest(functions):
+    """
+    Returns a digest of the filters or tests by their names and the
+    content of the extension files they are defined in. Jinja calls the
+    filters and tests with constant arguments already when compiling, so
+    their results may end up in the compiled code.
+    """
+    from . import cache
+
+    parts = []
+    files = set()
+    for name, func in sorted(functions.items()):
+        func = getattr(func, '__wrapped__', func)
+        module = getattr(func, '__module__', None)
+        parts += [name, repr(module), getattr(func, '__qualname__', '')]
+        if module == 'yasha_extensions':
+            filename = getattr(func, '__globals__', {}).get('__file__')
+            if filename:
+                files.add(os.path.abspath(filename))
+    for filename in sorted(files):
+        parts.append(filename)
+        try:
+            with open(filename, 'rb') as f:
+                parts.append(f.read())
+        except OSError:
+            parts.append(b'')
+    return cache.digest(*parts)
+
+
 def load_jinja(
         path, tests, filters, classes, mode,
-        trim_blocks, lstrip_blocks, keep_trailing_newline):
+        trim_blocks, lstrip_blocks, keep_trailing_newline,
+        cache_dir=None, enable_async=False):
+    import inspect
+    import jinja2 as jinja
     from jinja2.defaults import BLOCK_START_STRING, BLOCK_END_STRING, \
         VARIABLE_START_STRING, VARIABLE_END_STRING, \
         COMMENT_START_STRING, COMMENT_END_STRING, \
@@ -142,6 +291,13 @@ def load_jinja(
         None: jinja.Undefined,
     }
 
+    # Coroutine filters and tests can be awaited only in async mode
+    functions = list(tests.values()) + list(filters.values())
+    if any(inspect.iscoroutinefunction(f) for f in functions):
+        enable_async = True
+    from .filters import jinja_filters
+    filters = jinja_filters(filters, enable_async)
+
     env = jinja.Environment(
         block_start_string=BLOCK_START_STRING,
         block_end_string=BLOCK_END_STRING,
@@ -157,7 +313,9 @@ def load_jinja(
         keep_trailing_newline=keep_trailing_newline,
         extensions=classes,
         undefined=undefined[mode],
-        loader=jinja.FileSystemLoader(path)
+        loader=jinja.FileSystemLoader(path),
+        bytecode_cache=bytecode_cache(cache_dir) if cache_dir else None,
+        enable_async=enable_async,
     )
     env.tests.update(tests)
     env.filters.update(filters)